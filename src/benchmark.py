@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+"""
+non interactive performance benchmarks
+results are saved as json and compared to a baseline, a metric worse than its tolerance is a regression
+python3 benchmark.py [--save-baseline] [--tolerance 0.2] [--duration 1]
+exit status is 1 if a regression is found
+the committed baseline (benchmarks/baseline.json) was measured without tensorflow on a development machine,
+measure a new one with --save-baseline on the machine that runs the comparison
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from labels import LabelWriter, ReplayBuffer, label_directory
+from mcts import evaluate, expand, mcts
+from node import Node, Tree
+from numpy_network import NumpyNetwork
+from reinforcement import game
+from state import State
+from utils_board import init_map, get_pos_on_board
+
+RESULTS = "../benchmarks/results.json"
+BASELINE = "../benchmarks/baseline.json"
+
+class StubNetwork(object):
+    """
+    network with uniform policy and null value, the search is measured without inference
+    """
+    generation = 0
+    name = "stub"
+
+    def infer(self, board):
+        return self.infer_batch(board[None, :])
+
+    def infer_batch(self, boards):
+        return np.full((len(boards), 19 * 19), 1 / (19 * 19), np.float32), np.zeros(len(boards), np.float32)
+
+def random_weights(blocks=16, filters=64, seed=0):
+    """
+    return random exported weights (see network.Network.export) of a tower of blocks and filters
+    """
+    rng = np.random.RandomState(seed)
+    weights = dict()
+
+    def convolution(name, bn, ksize, inputs, outputs):
+        weights[name + "/kernel"] = (rng.randn(ksize, ksize, inputs, outputs) / np.sqrt(ksize * ksize * inputs)) \
+                                    .astype(np.float32)
+        weights[name + "/bias"] = np.zeros(outputs, np.float32)
+        weights[bn + "/scale"] = np.ones(outputs, np.float32)
+        weights[bn + "/shift"] = np.zeros(outputs, np.float32)
+
+    def fully_connected(name, inputs, outputs):
+        weights[name + "/kernel"] = (rng.randn(inputs, outputs) / np.sqrt(inputs)).astype(np.float32)
+        weights[name + "/bias"] = np.zeros(outputs, np.float32)
+
+    convolution("conv/conv2d", "conv/batch_normalization", 3, 3, filters)
+    for i in range(blocks):
+        scope = "res_" + str(i)
+        convolution(scope + "/conv2d", scope + "/batch_normalization", 3, filters, filters)
+        convolution(scope + "/conv2d_1", scope + "/batch_normalization_1", 3, filters, filters)
+    convolution("policy_head/conv2d", "policy_head/batch_normalization", 1, filters, 2)
+    fully_connected("policy_head/dense", 19 * 19 * 2, 19 * 19)
+    convolution("value_head/conv2d", "value_head/batch_normalization", 1, filters, 1)
+    fully_connected("value_head/dense", 19 * 19, 256)
+    fully_connected("value_head/dense_1", 256, 1)
+    return weights
+
+def random_boards(number, seed=0):
+    """
+    return number boards (number, 19, 19, 3) with random stones, third layer set to player 0
+    """
+    rng = np.random.RandomState(seed)
+    tiles = rng.randint(3, size=(number, 19, 19))
+    boards = np.zeros((number, 19, 19, 3), np.int8)
+    boards[:, :, :, 0] = tiles == 1
+    boards[:, :, :, 1] = tiles == 2
+    return boards
+
+def rate(function, duration, items=1):
+    """
+    call function for about duration seconds, return items processed per second
+    """
+    calls = 0
+    start = time.time()
+    while True:
+        function()
+        calls += 1
+        elapsed = time.time() - start
+        if elapsed >= duration:
+            return calls * items / elapsed
+
+def latency(function, duration):
+    """
+    call function for about duration seconds, return median milliseconds of a call
+    """
+    times = []
+    start = time.time()
+    while not times or time.time() - start < duration:
+        t = time.time()
+        function()
+        times.append(time.time() - t)
+    return float(np.median(times)) * 1000
+
+def metric(value, unit, higher_is_better=True):
+    return { "value": value, "unit": unit, "higher_is_better": higher_is_better }
+
+def bench_evaluate(duration):
+    """
+    win checks per second, scanning the board and with the bitboards of State
+    """
+    boards = random_boards(64)
+    positions = [ (x, y) for y in range(19) for x in range(19) ]
+    states = [ State(board) for board in boards ]
+
+    def scan():
+        for board in boards[:4]:
+            for pos in positions:
+                evaluate(board, 0, pos)
+
+    def bitboards():
+        for board, state in zip(boards[:4], states):
+            for pos in positions:
+                evaluate(board, 0, pos, state)
+
+    return { "evaluate": metric(rate(scan, duration, 4 * 361), "checks/s"),
+             "evaluate_state": metric(rate(bitboards, duration, 4 * 361), "checks/s") }
+
+def bench_get_pos_on_board(duration):
+    """
+    get_pos_on_board calls per second, scanning the board and with the empty tiles index of State
+    """
+    board = random_boards(1)[0]
+    state = State(board)
+    empty = int(np.sum(board[:, :, 0] + board[:, :, 1] == 0))
+
+    def scan():
+        for n in range(empty):
+            get_pos_on_board(board, n)
+
+    def index():
+        for n in range(empty):
+            get_pos_on_board(board, n, state)
+
+    return { "get_pos_on_board": metric(rate(scan, duration, empty), "calls/s"),
+             "get_pos_on_board_state": metric(rate(index, duration, empty), "calls/s") }
+
+def bench_mcts(duration, trials=200):
+    """
+    playouts per second with the stub network from an empty board, one at a time and in batches of 8
+    """
+    network = StubNetwork()
+    results = dict()
+    for batch_size in (1, 8):
+        def search():
+            board = np.zeros((19, 19, 3), np.int8)
+            root = Node(0, Tree())
+            expand(root, board, 0, network)
+            mcts(board, 0, root, network, trials=trials, batch_size=batch_size)
+        results["mcts_batch_" + str(batch_size)] = metric(rate(search, duration, trials), "playouts/s")
+    return results
+
+def bench_infer(duration, batch_sizes=(1, 8, 32, 64)):
+    """
+    milliseconds per infer_batch of the numpy network and, if installed, of the tensorflow network
+    the networks have random weights of the 16 x 64 tower
+    """
+    networks = [ ("numpy", NumpyNetwork(0, weights=random_weights())) ]
+    try:
+        from network import Network
+        # no saved model of version -2: new graph with random weights
+        networks.append(("tensorflow", Network(-2, logs=False)))
+    except ImportError:
+        print ("tensorflow not installed, tensorflow inference skipped")
+    results = dict()
+    for name, network in networks:
+        for batch_size in batch_sizes:
+            boards = random_boards(batch_size)
+            results["infer_" + name + "_" + str(batch_size)] = \
+                metric(latency(lambda: network.infer_batch(boards), duration), "ms", False)
+    return results
+
+def bench_labels(duration, turns=60):
+    """
+    games appended per second to a shard, labels sampled per second from the replay buffer
+    """
+    rng = np.random.RandomState(0)
+    start = init_map()
+    record = (start, rng.randint(361, size=turns), np.arange(turns) % 2, np.where(np.arange(turns) % 2, 1, -1),
+              [ rng.choice(361, 30, replace=False) for _ in range(turns) ],
+              [ rng.randint(1, 100, 30) for _ in range(turns) ])
+    directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        # labels are found relative to the working directory, ../labels/labels_{version}
+        os.makedirs(os.path.join(directory, "src"))
+        os.chdir(os.path.join(directory, "src"))
+        with LabelWriter(label_directory(1), "bench") as writer:
+            write = rate(lambda: writer.append(*record), duration)
+        buffer = ReplayBuffer(1, 1)
+        sample = rate(lambda: buffer.sample(256), duration, 256)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    return { "labels_append": metric(write, "games/s"), "labels_sample": metric(sample, "labels/s") }
+
+def bench_self_play(duration):
+    """
+    complete self play games per minute with the stub network, from an empty board
+    """
+    network = StubNetwork()
+    start = np.zeros((19, 19, 3), np.int8)
+    return { "self_play": metric(rate(lambda: game(network, network, start=start), duration) * 60, "games/min") }
+
+BENCHMARKS = (bench_evaluate, bench_get_pos_on_board, bench_mcts, bench_infer, bench_labels, bench_self_play)
+
+def compare(results, baseline, tolerance):
+    """
+    return list of (name, value, baseline value) of results worse than baseline by more than tolerance
+    a baseline entry may hold its own tolerance
+    """
+    regressions = []
+    for name, reference in sorted(baseline.items()):
+        if name not in results:
+            continue
+        value = results[name]["value"]
+        limit = reference.get("tolerance", tolerance)
+        if reference["higher_is_better"]:
+            worse = value < reference["value"] * (1 - limit)
+        else:
+            worse = value > reference["value"] * (1 + limit)
+        if worse:
+            regressions.append((name, value, reference["value"]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="performance benchmarks")
+    parser.add_argument("--duration", type=float, default=1.0, help="seconds per measure")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown")
+    parser.add_argument("--output", default=RESULTS, help="json results")
+    parser.add_argument("--baseline", default=BASELINE, help="json baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="save results as the new baseline")
+    args = parser.parse_args()
+
+    results = dict()
+    for benchmark in BENCHMARKS:
+        print (benchmark.__name__, flush=True)
+        results.update(benchmark(args.duration))
+    for name, result in sorted(results.items()):
+        print ("{:28} {:14.2f} {}".format(name, result["value"], result["unit"]))
+
+    paths = [ args.output ] + ([ args.baseline ] if args.save_baseline else [])
+    for path in paths:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.save_baseline or not os.path.isfile(args.baseline):
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for name, value, reference in regressions:
+        print ("REGRESSION {}: {:.2f} (baseline {:.2f})".format(name, value, reference))
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
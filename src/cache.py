@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+"""
+cache of network evaluations, placed in front of Network.infer
+positions are keyed by their zobrist hash, made canonical over the 8 board symmetries
+"""
+
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import Future
+from state import board_hashes
+from utils_board import SYMMETRIES, INVERSE_SYMMETRIES
+
+# approximate memory of an entry: canonical policy (361 float32) and python overhead
+ENTRY_SIZE = 19 * 19 * 4 + 400
+
+class EvalCache(object):
+    """
+    LRU cache of evaluations with the same infer / infer_batch interface as Network
+    cleared when the weights of the network change
+    """
+    def __init__(self, network, max_memory=256 * 2**20):
+        """
+        network: evaluated on cache misses
+        max_memory: memory cap in bytes, least recently used entries are evicted above it
+        """
+        self._network = network
+        self._max_entries = max(1, max_memory // ENTRY_SIZE)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # futures of the positions being evaluated, shared by the threads asking for them
+        self._pending = dict()
+        self._generation = network.generation
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """
+        remove every entry
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def _key(self, board, hashes):
+        """
+        return canonical key of board and the symmetry leading to it
+        """
+        if hashes is None:
+            hashes = board_hashes(board)
+        s = min(range(8), key=hashes.__getitem__)
+        return (hashes[s], int(board[0, 0, 2])), s
+
+    def _get(self, key):
+        """
+        return entry of key or None, must be called with lock held
+        """
+        if self._network.generation != self._generation:
+            self._entries.clear()
+            self._generation = self._network.generation
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return entry
+
+    def _put(self, key, s, p, v):
+        """
+        store policy p (361) in canonical orientation and value v, return the canonical policy
+        """
+        canonical = p[SYMMETRIES[s]].astype(np.float32)
+        with self._lock:
+            self._entries[key] = (canonical, v)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        return canonical
+
+    def _evaluate(self, boards, keys):
+        """
+        return policies and values of boards (n, 19, 19, 3) of keys (see _key)
+        only positions missing from the cache are sent to the network, once, in one batch
+        positions already sent by another thread are waited for instead
+        """
+        ps = np.zeros((len(boards), 19 * 19), np.float32)
+        vs = np.zeros(len(boards), np.float32)
+        # key => indices of the boards of a position evaluated here, the first one is sent to the network
+        missing = OrderedDict()
+        # key => future of another thread, indices of the boards waiting for it
+        waiting = dict()
+        with self._lock:
+            for i, (key, s) in enumerate(keys):
+                if key in missing:
+                    missing[key].append(i)
+                    self.hits += 1
+                elif key in self._pending:
+                    waiting.setdefault(key, (self._pending[key], []))[1].append(i)
+                    self.hits += 1
+                else:
+                    entry = self._get(key)
+                    if entry is None:
+                        missing[key] = [ i ]
+                        self._pending[key] = Future()
+                    else:
+                        ps[i] = entry[0][INVERSE_SYMMETRIES[s]]
+                        vs[i] = entry[1]
+        if missing:
+            try:
+                p, v = self._network.infer_batch(boards[[ indices[0] for indices in missing.values() ]])
+            except Exception as e:
+                with self._lock:
+                    for key in missing:
+                        self._pending.pop(key).set_exception(e)
+                raise
+            for (key, indices), policy, value in zip(missing.items(), p, v):
+                canonical = self._put(key, keys[indices[0]][1], policy, value)
+                for i in indices:
+                    ps[i] = canonical[INVERSE_SYMMETRIES[keys[i][1]]]
+                    vs[i] = value
+                with self._lock:
+                    self._pending.pop(key).set_result((canonical, value))
+        for future, indices in waiting.values():
+            canonical, value = future.result()
+            for i in indices:
+                ps[i] = canonical[INVERSE_SYMMETRIES[keys[i][1]]]
+                vs[i] = value
+        return ps, vs
+
+    def infer(self, board, hashes=None):
+        """
+        infer policy and value from board state
+        hashes: State.get_hashes() of board, computed from board if not given
+        """
+        return self._evaluate(board[None, :], [ self._key(board, hashes) ])
+
+    def infer_batch(self, boards):
+        """
+        infer policies and values from a batch of board states (n, 19, 19, 3)
+        """
+        return self._evaluate(boards, [ self._key(board, None) for board in boards ])
+
+    def stats(self):
+        """
+        return hits, misses, number of entries and approximate memory used
+        """
+        with self._lock:
+            return { "hits": self.hits, "misses": self.misses,
+                     "entries": len(self._entries), "memory": len(self._entries) * ENTRY_SIZE }
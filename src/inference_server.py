@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""
+inference service shared by many concurrent games
+boards submitted from any thread are gathered into dynamic batches, evaluated with one network call
+"""
+
+import threading
+import queue
+import time
+import numpy as np
+from concurrent.futures import Future
+
+class InferenceServer(object):
+    """
+    batching front of a network, with the same infer / infer_batch interface as Network
+    a batch is sent when it holds max_batch_size boards, or max_wait seconds after its first board
+    """
+    def __init__(self, network, max_batch_size=64, max_wait=0.002):
+        """
+        start serving thread
+        """
+        self._network = network
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._requests = queue.Queue()
+        self.batches = 0
+        self.boards = 0
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    @property
+    def generation(self):
+        """
+        generation of the weights of the served network
+        """
+        return self._network.generation
+
+    def submit(self, boards):
+        """
+        queue boards (n, 19, 19, 3), return future of (policies, values)
+        """
+        future = Future()
+        self._requests.put((boards, future))
+        return future
+
+    def infer(self, board):
+        """
+        infer policy and value from board state
+        """
+        return self.submit(board[None, :]).result()
+
+    def infer_batch(self, boards):
+        """
+        infer policies and values from a batch of board states (n, 19, 19, 3)
+        """
+        return self.submit(boards).result()
+
+    def _next_batch(self):
+        """
+        wait for requests, return a list of them or None when closed
+        """
+        request = self._requests.get()
+        if request is None:
+            return None
+        batch = [ request ]
+        size = len(request[0])
+        deadline = time.time() + self._max_wait
+        while size < self._max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                # serve what is gathered, then stop
+                self._requests.put(None)
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    def _serve(self):
+        """
+        serving loop, one network call per batch
+        """
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            batch = [ (boards, future) for boards, future in batch
+                      if future.set_running_or_notify_cancel() ]
+            if not batch:
+                continue
+            try:
+                ps, vs = self._network.infer_batch(np.concatenate([ boards for boards, _ in batch ]))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.boards += len(ps)
+            start = 0
+            for boards, future in batch:
+                end = start + len(boards)
+                future.set_result((ps[start:end], vs[start:end]))
+                start = end
+
+    def close(self):
+        """
+        serve pending requests and stop serving thread
+        """
+        self._requests.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
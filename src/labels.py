@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+"""
+append-only storage of self play games with fixed dtypes
+a game is recorded as its starting position, its moves and the sparse visit counts of each move,
+training labels (state, policy, outcome) are rebuilt from it when they are sampled
+labels of a version are stored in a directory, as shards written by a single writer each
+a shard {name} is made of one raw file {name}.{field} per field
+and of an index {name}.index (json) giving the number of complete turns, visits and games
+"""
+
+import os
+import glob
+import json
+import numpy as np
+
+# name, dtype and shape of an element of each field, and what an element is
+FIELDS = (("moves", np.int16, (), "turns"),             # tile played, y * 19 + x
+          ("players", np.int8, (), "turns"),            # player of the turn
+          ("outcomes", np.int8, (), "turns"),           # 1 if player won the game, else -1
+          ("visited", np.int16, (), "turns"),           # number of visited children
+          ("tiles", np.int16, (), "visits"),            # tile of a visited child
+          ("visits", np.int32, (), "visits"),           # visit count of a visited child
+          ("lengths", np.int32, (), "games"),           # number of turns of a game
+          ("starts", np.int8, (19, 19, 3), "games"))    # starting position of a game
+
+def label_directory(version):
+    """
+    directory of the labels of version
+    """
+    return "../labels/labels_" + str(version)
+
+def read_index(path):
+    """
+    return index of shard path (without extension), empty if not written yet
+    """
+    try:
+        with open(path + ".index") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return { "turns": 0, "visits": 0, "games": 0 }
+
+def shards(directory):
+    """
+    return paths (without extension) of the shards of directory
+    """
+    return sorted(f[:-len(".index")] for f in glob.glob(os.path.join(directory, "*.index")))
+
+def read_shard(path, mmap=False):
+    """
+    return dict of the arrays of each field of shard path
+    only data listed in the index is returned, partial appends are ignored
+    """
+    index = read_index(path)
+    arrays = dict()
+    for name, dtype, shape, unit in FIELDS:
+        length = index[unit]
+        if mmap and length:
+            arrays[name] = np.memmap(path + "." + name, dtype, "r", shape=(length,) + shape)
+        else:
+            arrays[name] = np.fromfile(path + "." + name, dtype, length * int(np.prod(shape, dtype=int))) \
+                             .reshape((length,) + shape)
+    return arrays
+
+class LabelWriter(object):
+    """
+    append games to a shard, cost of an append only depends on the size of the game
+    """
+    def __init__(self, directory, name):
+        """
+        open shard name of directory, drop data not listed in its index (interrupted append)
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._path = os.path.join(directory, name)
+        self._index = read_index(self._path)
+        self._files = []
+        for field, dtype, shape, unit in FIELDS:
+            filename = self._path + "." + field
+            f = open(filename, "r+b" if os.path.exists(filename) else "w+b")
+            f.truncate(self._index[unit] * np.dtype(dtype).itemsize * int(np.prod(shape, dtype=int)))
+            f.seek(0, os.SEEK_END)
+            self._files.append(f)
+
+    def append(self, start, moves, players, outcomes, tiles, visits):
+        """
+        append a game, then atomically publish it in the index
+        start: starting position (19, 19, 3)
+        moves, players, outcomes: tile played, player and outcome of each turn
+        tiles, visits: list of visited tiles and their visit counts for each turn
+        """
+        data = { "moves": moves, "players": players, "outcomes": outcomes,
+                 "visited": [ len(t) for t in tiles ],
+                 "tiles": np.concatenate(tiles), "visits": np.concatenate(visits),
+                 "lengths": [ len(moves) ], "starts": [ start ] }
+        for f, (name, dtype, shape, _) in zip(self._files, FIELDS):
+            np.ascontiguousarray(data[name], dtype).reshape((-1,) + shape).tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        self._index["turns"] += len(moves)
+        self._index["visits"] += len(data["tiles"])
+        self._index["games"] += 1
+        tmp = self._path + ".index.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path + ".index")
+        # make the rename itself durable
+        directory = os.open(os.path.dirname(os.path.abspath(self._path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def close(self):
+        """
+        close shard files
+        """
+        for f in self._files:
+            f.close()
+        self._files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def get_label(shard, turn):
+    """
+    rebuild label (state, policy, outcome) of turn of a shard
+    shard: dict of read_shard, with offsets of turns of games and of visits of turns
+    state is the board before the move, third layer set to the player to move
+    policy is the distribution of visit counts
+    """
+    game = np.searchsorted(shard["game_offsets"], turn, "right") - 1
+    first = shard["game_offsets"][game]
+    state = np.array(shard["starts"][game])
+    # stones never move, the order of previous moves does not matter
+    state.reshape((19 * 19, 3))[shard["moves"][first:turn], shard["players"][first:turn]] = 1
+    state[:,:,2] = shard["players"][turn]
+    begin, end = shard["visit_offsets"][turn], shard["visit_offsets"][turn + 1]
+    policy = np.zeros(19 * 19, np.float32)
+    visits = shard["visits"][begin:end]
+    policy[shard["tiles"][begin:end]] = visits / max(np.sum(visits), 1)
+    return state, policy, shard["outcomes"][turn]
+
+class ReplayBuffer(object):
+    """
+    labels of the most recent versions, memory mapped and sampled by index without loading them
+    """
+    def __init__(self, version, size, recency=0):
+        """
+        take shards of version, version - 1, ... until the window holds at least size labels
+        recency: 0 for uniform sampling, else labels are weighted by exp(-recency * age of version)
+        """
+        self._shards = []
+        weights = []
+        length = 0
+        age = 0
+        while length < size and version - age > 0:
+            for path in shards(label_directory(version - age)):
+                shard = read_shard(path, mmap=True)
+                if len(shard["moves"]):
+                    shard["game_offsets"] = np.cumsum(np.append(0, shard["lengths"]))
+                    shard["visit_offsets"] = np.cumsum(np.append(0, shard["visited"]))
+                    self._shards.append(shard)
+                    weights.append(len(shard["moves"]) * np.exp(-recency * age))
+                    length += len(shard["moves"])
+            age += 1
+        self._offsets = np.cumsum([ 0 ] + [ len(shard["moves"]) for shard in self._shards ])
+        self._weights = np.array(weights) / np.sum(weights) if weights else None
+        self._recency = recency
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def _indices(self, batch_size):
+        """
+        return batch_size random label indices of the window
+        """
+        if not self._recency:
+            return np.random.randint(0, len(self), batch_size)
+        # pick shards by weight, then labels uniformly in them
+        shard = np.random.choice(len(self._shards), batch_size, p=self._weights)
+        lengths = self._offsets[shard + 1] - self._offsets[shard]
+        return self._offsets[shard] + (np.random.random_sample(batch_size) * lengths).astype(int)
+
+    def get(self, indices):
+        """
+        return states, policies and outcomes of labels indices, only these labels are read
+        """
+        indices = np.asarray(indices)
+        shard = np.searchsorted(self._offsets, indices, "right") - 1
+        states = np.empty((len(indices), 19, 19, 3), np.int8)
+        policies = np.empty((len(indices), 19 * 19), np.float32)
+        outcomes = np.empty(len(indices), np.int8)
+        for i, (s, index) in enumerate(zip(shard, indices)):
+            states[i], policies[i], outcomes[i] = get_label(self._shards[s], index - self._offsets[s])
+        return states, policies, outcomes
+
+    def sample(self, batch_size):
+        """
+        return states, policies and outcomes of batch_size random labels
+        """
+        return self.get(self._indices(batch_size))
@@ -3,19 +3,35 @@
 """
 perform a monte carlo tree search for a given board
 with the help of a policy and value network
+functions take an optional stats (search_stats.SearchStats) recording the time of each phase
 """
 
+import time
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from cache import EvalCache
 from node import Node
-from utils_board import update_board_player, put_on_board, get_pos_on_board
+from search_stats import SearchStats
+from state import State
+from time_control import SearchBudget
+from utils_board import update_board_player, put_on_board, get_pos_on_board, get_empty_tiles
 
-def evaluate(board, player, pos):
+def evaluate(board, player, pos, state=None, stats=None):
     """
     give a score to the current state
     board => (19, 19, 3)
     player => 0 or 1
     pos => (x, y)
+    state => State of board, O(1) check if given
     """
+    if stats is not None:
+        start = time.perf_counter()
+        win = evaluate(board, player, pos, state)
+        stats.add("win_check", start)
+        return win
+    if state is not None:
+        return state.is_win(player, pos)
+
     maps = [ board[:,:,0], board[:,:,1] ]
     pmap = maps[player]
 
@@ -41,11 +57,40 @@ def evaluate(board, player, pos):
 
     return 0
 
-def expand(node, board, player, network):
+def infer(network, board, state=None, stats=None):
+    """
+    run network on board, giving the incremental hashes of state to a cache
+    """
+    if stats is not None:
+        start = time.perf_counter()
+        result = infer(network, board, state)
+        stats.add("network", start)
+        stats.evaluated += 1
+        return result
+    if state is not None and isinstance(network, EvalCache):
+        return network.infer(board, state.get_hashes())
+    return network.infer(board)
+
+def transposition_key(node, player, state):
+    """
+    return key of the position in the transposition table of the tree of node, None without table
+    """
+    if node.get_tree().table is None or state is None:
+        return None
+    return (state.get_hashes()[0], player)
+
+def expand(node, board, player, network, state=None, stats=None):
     """
     expand node
     predict state value, and probability for children using neural network
+    reuse children and value of an already expanded identical position with a transposition table
     """
+    table = node.get_tree().table
+    key = transposition_key(node, player, state)
+    if key is not None:
+        value = table.link(node, key)
+        if value is not None:
+            return value
     update_board_player(board, player)
     # dummy values
     """
@@ -53,69 +98,251 @@ def expand(node, board, player, network):
     p = p[np.where((board[:,:,0] + board[:,:,1]).flatten() == 0)]
     # run network (time consuming)
     """
-    p, v = network.infer(board)
+    p, v = infer(network, board, state, stats)
+    value = expand_with(node, board, player, p[0], v[0], state)
+    if key is not None:
+        table.store(key, node, value)
+    return value
+
+def expand_with(node, board, player, p, v, state=None):
+    """
+    expand node with policy p (361) and value v already predicted for board
+    return value of node
+    """
     # remove already played tiles
-    p = p[0][np.where((board[:,:,0] + board[:,:,1]).flatten() == 0)]
+    p = p[get_empty_tiles(board, state)]
     # negative if black
-    p *= (1 - 2 * player)
-    v *= (1 - 2 * player)
+    p = p * (1 - 2 * player)
     node.expand_children(p)
-    return v
+    return v * (1 - 2 * player)
 
-def select(node, board, player):
+def select(node, board, player, state=None, stats=None):
     """
     return chosen node, updated board, new coordinates
     """
+    if stats is not None:
+        start = time.perf_counter()
+        result = select(node, board, player, state)
+        stats.add("selection", start)
+        stats.select()
+        return result
     # choose next node
-    n = np.argmax(node.get_policy() * (1 - 2 * player))
+    n = node.select_child(1 - 2 * player)
     child = node.get_child(n)
     child.add_frequency()
     # get coordinates of next move, and update board
-    x, y = get_pos_on_board(board, n)
-    put_on_board(board, (x, y), player, 1)
+    x, y = get_pos_on_board(board, n, state)
+    put_on_board(board, (x, y), player, 1, state)
     return child, board, (x, y), player ^ 1
 
-def search(node, board, player, network):
+def search(node, board, player, network, state=None, stats=None):
     """
     node: object Node
     board: np.array(3,19,19)
     player: 0 for white, 1 for black
+    state: State of board, kept up to date
     do actions on a level of deepness
     """
-    child, board, pos, next_player = select(node, board, player)
+    child, board, pos, next_player = select(node, board, player, state, stats)
     # evaluate or keep searching
     if child.leaf():
-        value = evaluate(board, player, pos)
+        value = evaluate(board, player, pos, state, stats) * (1 - 2 * player)
         # if not a winning move
         if not value:
-            value = expand(child, board, next_player, network)
+            value = expand(child, board, next_player, network, state, stats)
     else:
-        value = search(child, board, next_player, network)
+        value = search(child, board, next_player, network, state, stats)
     # clean board and back propagate
-    put_on_board(board, pos, player, 0)
+    if stats is not None:
+        start = time.perf_counter()
+    put_on_board(board, pos, player, 0, state)
     child.score(value)
+    if stats is not None:
+        stats.add("backup", start)
     return value
 
-def mcts(board, player, root, network):
+def search_batch(root, board, player, network, batch_size, state=None, virtual_loss=1, stats=None):
+    """
+    descend batch_size paths, a virtual loss on each visited node makes the next paths differ
+    evaluate all new leaves with one network call, then back propagate every path
+    """
+    table = root.get_tree().table
+    paths = []
+    leaves = dict()
+    for _ in range(batch_size):
+        node, current, path, leaf = root, player, [], None
+        while True:
+            child, board, pos, next_player = select(node, board, current, state, stats)
+            child.score(-(1 - 2 * current) * virtual_loss)
+            path.append((child, pos, current))
+            if not child.leaf():
+                node, current = child, next_player
+                continue
+            value = evaluate(board, current, pos, state, stats) * (1 - 2 * current)
+            # if not a winning move, wait for network (once per leaf)
+            if not value:
+                key = transposition_key(child, next_player, state)
+                known = None if key is None else table.link(child, key)
+                if known is not None:
+                    value = known
+                    break
+                # with a table, the same position reached by another move order is evaluated once
+                leaf = child.get_index() if key is None else key
+                if leaf not in leaves:
+                    leaf_board = np.copy(board)
+                    update_board_player(leaf_board, next_player)
+                    leaves[leaf] = (child, leaf_board, next_player, key, dict())
+                elif leaves[leaf][0].get_index() != child.get_index():
+                    leaves[leaf][4][child.get_index()] = child
+            break
+        # clean board
+        for _, pos, current in reversed(path):
+            put_on_board(board, pos, current, 0, state)
+        paths.append((path, value, leaf))
+        if stats is not None:
+            stats.end_playout()
+
+    # evaluate every leaf at once
+    values = dict()
+    if leaves:
+        keys = list(leaves)
+        boards = np.array([ leaves[k][1] for k in keys ])
+        if stats is not None:
+            start = time.perf_counter()
+        ps, vs = network.infer_batch(boards)
+        if stats is not None:
+            stats.add("network", start)
+            stats.evaluated += len(boards)
+        for k, leaf_board, p, v in zip(keys, boards, ps, vs):
+            child, _, next_player, key, transpositions = leaves[k]
+            values[k] = expand_with(child, leaf_board, next_player, p, v)
+            if key is not None:
+                table.store(key, child, values[k])
+                for other in transpositions.values():
+                    table.link(other, key)
+
+    # remove virtual loss and back propagate
+    if stats is not None:
+        start = time.perf_counter()
+    for path, value, leaf in paths:
+        if leaf is not None:
+            value = values[leaf]
+        for child, _, current in path:
+            child.score(value + (1 - 2 * current) * virtual_loss)
+    if stats is not None:
+        stats.add("backup", start)
+
+def search_shared(root, board, player, network, state=None, virtual_loss=1, stats=None):
+    """
+    do one playout on a tree shared between threads
+    board (and its state) is private to the calling thread
+    tree is only read and updated under its lock, network runs without it
+    """
+    lock = root.get_tree().lock
+    table = root.get_tree().table
+    path = []
+    with lock:
+        node, current = root, player
+        while True:
+            child, board, pos, next_player = select(node, board, current, state, stats)
+            child.score(-(1 - 2 * current) * virtual_loss)
+            path.append((child, pos, current))
+            if child.leaf():
+                break
+            node, current = child, next_player
+    value = evaluate(board, current, pos, state, stats) * (1 - 2 * current)
+    # if not a winning move
+    if not value:
+        key = transposition_key(child, next_player, state)
+        with lock:
+            known = None if key is None else table.link(child, key)
+        if known is not None:
+            value = known
+        else:
+            update_board_player(board, next_player)
+            p, v = infer(network, board, state, stats)
+            with lock:
+                # another thread may have expanded the leaf meanwhile
+                if child.leaf():
+                    value = expand_with(child, board, next_player, p[0], v[0], state)
+                    if key is not None:
+                        table.store(key, child, value)
+                else:
+                    value = v[0] * (1 - 2 * next_player)
+    # remove virtual loss, back propagate and clean board
+    if stats is not None:
+        start = time.perf_counter()
+    with lock:
+        for child, _, current in path:
+            child.score(value + (1 - 2 * current) * virtual_loss)
+    for _, pos, current in reversed(path):
+        put_on_board(board, pos, current, 0, state)
+    if stats is not None:
+        stats.add("backup", start)
+        stats.end_playout()
+
+def search_parallel(root, board, player, network, budget, threads, stats=None):
+    """
+    run the playouts of budget (SearchBudget) with threads workers sharing the tree of root
+    each worker searches on its own copy of board, and records its own stats merged at the end
+    """
+    def worker():
+        private = np.copy(board)
+        state = State(private)
+        private_stats = None if stats is None else SearchStats()
+        while budget.take(root):
+            search_shared(root, private, player, network, state, stats=private_stats)
+        return private_stats
+
+    with ThreadPoolExecutor(threads) as executor:
+        for future in [ executor.submit(worker) for _ in range(threads) ]:
+            private_stats = future.result()
+            if stats is not None:
+                stats.merge(private_stats)
+
+def mcts(board, player, root, network, trials=6, batch_size=1, threads=1, state=None, deadline=None,
+         stats=None):
     """
     board: np.array((3, 19, 19))
     take board, player turn (0, 1), root node
+    trials: number of search (None: no limit), batch_size: number of leaves evaluated per network call
+    threads: number of workers searching the tree in parallel (batch_size is then ignored)
+    state: State of board, kept up to date, built if not given
+    deadline: time.time() at which the search stops, earlier if the chosen move can no longer change
+    stats: SearchStats filled with the counters and timers of the search, None to disable
     return next move, updated board, policy vector, next root and boolean for game status
     """
-    # parameters: number of search
-    trials = 6
+    if trials is None and deadline is None:
+        raise ValueError("mcts needs trials or a deadline")
+    if state is None:
+        state = State(board)
+    budget = SearchBudget(trials, deadline)
+    if stats is not None:
+        stats.start(root)
 
     # build tree
-    for _ in range(trials):
-        search(root, board, player, network)
+    if threads > 1:
+        search_parallel(root, board, player, network, budget, threads, stats)
+    elif batch_size > 1:
+        n = budget.take(root, batch_size)
+        while n:
+            search_batch(root, board, player, network, n, state, stats=stats)
+            n = budget.take(root, batch_size)
+    else:
+        while budget.take(root):
+            search(root, board, player, network, state, stats)
+            if stats is not None:
+                stats.end_playout()
+    if stats is not None:
+        stats.finish(root)
 
     # reshape policy to (361)
-    p = np.ones(361) - (board[:,:,0] + board[:,:,1]).flatten()
-    p[ p == 1 ] = root.get_policy() * (1 - 2 * player)
+    p = np.zeros(361)
+    p[get_empty_tiles(board, state)] = root.get_policy() * (1 - 2 * player)
 
     # get coordinates of chosen move, and update board
     n = root.get_max_frequency_move()
-    x, y = get_pos_on_board(board, n)
-    put_on_board(board, (x, y), player, 1)
+    x, y = get_pos_on_board(board, n, state)
+    put_on_board(board, (x, y), player, 1, state)
 
-    return ((x, y), board, p, root.get_child(n), evaluate(board, player, (x, y)))
+    return ((x, y), board, p, root.get_child(n), evaluate(board, player, (x, y), state))
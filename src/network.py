@@ -1,25 +1,68 @@
 import os.path
+import re
+import threading
 import tensorflow as tf
 import numpy as np
+from numpy_network import export_path
 
 """
 class Network
 """
 
+# epsilon of tf.layers.batch_normalization
+BN_EPSILON = 1e-3
+
+def fold(values):
+    """
+    return inference weights (see export) from values of the variables of a network
+    a batch normalization follows a relu here, it can not be merged in the convolution,
+    it is folded into a per channel scale and shift, values already folded are kept
+    """
+    weights = dict()
+    for name, value in values.items():
+        layer, variable = name.rsplit("/", 1)
+        if "/conv2d" in layer or "/dense" in layer or variable in ("scale", "shift"):
+            weights[name] = value
+        elif variable == "gamma":
+            scale = value / np.sqrt(values[layer + "/moving_variance"] + BN_EPSILON)
+            weights[layer + "/scale"] = scale
+            weights[layer + "/shift"] = values[layer + "/beta"] - values[layer + "/moving_mean"] * scale
+    return weights
+
 class Network(object):
-    def __init__(self, version):
+    def __init__(self, version, inference=False, logs=True, name="model", blocks=16, filters=64):
         """
         init network
+        inference: only load the exported model of version (see export), no training graph
+        falls back to the full model if version was not exported
+        logs: write the graph for tensorboard in ./logs (never in inference mode)
+        name: models of name are saved apart, "student" for a distilled network
+        blocks, filters: residual blocks and filters of the tower of a new network
         """
-        path_to_restore_model = "../models/model-" + str(version) + ".meta";
+        path_to_restore_model = "../models/" + name + "-" + str(version) + ".meta";
         self.version = version
+        self.name = name
+        # incremented each time weights change, see cache.EvalCache
+        self.generation = 0
+        # background write of a checkpoint or an export, see wait
+        self._writing = None
         self._graph = tf.Graph()
+        self.inference = inference and os.path.isfile(export_path(version, name=name))
         with self._graph.as_default():
             self._sess = tf.Session(graph=self._graph)
+            if self.inference:
+                weights = dict(np.load(export_path(version, name=name)))
+                self._state = tf.placeholder(tf.float32, shape=[None, 19, 19, 3])
+                self._isTraining = tf.placeholder_with_default(False, [])
+                self._p_head, self._v_head = inference_network(self._state, weights)
+                self._variables = tf.global_variables()
+                self._graph.finalize()
+                self._load(weights)
+                return
             if os.path.isfile(path_to_restore_model):
                 print("restore")
-                saver = tf.train.import_meta_graph(path_to_restore_model)
-                saver.restore(self._sess, tf.train.latest_checkpoint('../models/'))
+                self._saver = tf.train.import_meta_graph(path_to_restore_model)
+                self._saver.restore(self._sess, path_to_restore_model[:-len(".meta")])
                 self._p_head = self._graph.get_tensor_by_name("policy_head/Tanh:0")
                 self._v_head = self._graph.get_tensor_by_name("value_head/strided_slice:0")
                 self._state = self._graph.get_tensor_by_name("Placeholder:0")
@@ -27,10 +70,11 @@ class Network(object):
                 self._loss = self._graph.get_tensor_by_name("loss/add_1:0")
                 self._train_winner = self._graph.get_tensor_by_name("loss/Placeholder_1:0")
                 self._train_p_mcts = self._graph.get_tensor_by_name("loss/Placeholder:0")
+                self._optimizer = self._graph.get_collection(tf.GraphKeys.TRAIN_OP)[0]
             else :
                 self._state = tf.placeholder(tf.float32, shape=[None, 19, 19, 3])
                 self._isTraining = tf.placeholder(tf.bool)
-                self._p_head, self._v_head = network(self._state, self._isTraining)
+                self._p_head, self._v_head = network(self._state, self._isTraining, blocks, filters)
                 (self._optimizer,
                  self._loss, self._train_p_mcts,
                  self._train_winner) = loss_function(self._state,
@@ -38,8 +82,11 @@ class Network(object):
                                                      self._v_head)
                 self._glob = tf.global_variables_initializer()
                 self._sess.run(self._glob)
-            writer = tf.summary.FileWriter('./logs')
-            writer.add_graph(self._graph)
+                self._saver = tf.train.Saver()
+            self._variables = tf.global_variables()
+            if logs:
+                writer = tf.summary.FileWriter('./logs')
+                writer.add_graph(self._graph)
 
     def upgrade(self):
         """ """
@@ -49,15 +96,83 @@ class Network(object):
         """
         infer policy and value from board state
         """
+        return self.infer_batch(board[None, :])
+
+    def infer_batch(self, boards):
+        """
+        infer policies and values from a batch of board states (n, 19, 19, 3)
+        """
         return self._sess.run([self._p_head, self._v_head],
-                              feed_dict={self._state: board[None, :], self._isTraining: False})
+                              feed_dict={self._state: boards, self._isTraining: False})
 
-    def save_session(self):
-        with self._graph.as_default():
-            saver = tf.train.Saver()
-            saver_path = saver.save(self._sess, "../models/model-" + str(self.version))
-            print("model saved in %s" %saver_path)
-            return
+    def get_weights(self):
+        """
+        return dict name: value of the variables of the network, a copy in memory
+        """
+        values = self._sess.run(self._variables)
+        return { v.name[:-len(":0")]: value for v, value in zip(self._variables, values) }
+
+    def _load(self, weights):
+        """
+        assign weights to the variables, through their initializer: no graph change
+        """
+        for variable in self._variables:
+            variable.load(weights[variable.name[:-len(":0")]], self._sess)
+
+    def set_weights(self, weights):
+        """
+        copy weights of another network (get_weights) into this one, in place
+        weights of a full network are folded if this network is inference only
+        """
+        self.wait()
+        self._load(fold(weights) if self.inference else weights)
+        self.generation += 1
+
+    def _write(self, target, *args):
+        """
+        run target(*args) in background, after the previous write, without waiting for it
+        """
+        def write(previous):
+            if previous is not None:
+                previous.join()
+            target(*args)
+        self._writing = threading.Thread(target=write, args=(self._writing,))
+        self._writing.start()
+
+    def wait(self):
+        """
+        wait for the end of the background writes, each one waits for the previous one
+        """
+        if self._writing is not None:
+            self._writing.join()
+            self._writing = None
+
+    def _save(self, path):
+        saver_path = self._saver.save(self._sess, path)
+        print("model saved in %s" %saver_path)
+
+    def save_session(self, wait=False):
+        """
+        save a checkpoint of version in background, training waits for it
+        """
+        if self.inference:
+            raise RuntimeError("inference only network has no checkpoint")
+        self._write(self._save, "../models/" + self.name + "-" + str(self.version))
+        if wait:
+            self.wait()
+
+    def _export(self, path, weights):
+        np.savez(path, **weights)
+        print("model exported in %s" % path)
+
+    def export(self, wait=False):
+        """
+        save weights needed by inference to export_path(version, name), batch normalizations folded
+        weights are copied at once, the file is written in background
+        """
+        self._write(self._export, export_path(self.version, name=self.name), fold(self.get_weights()))
+        if wait:
+            self.wait()
 
     def train(self, board, p, z):
         """
@@ -67,10 +182,11 @@ class Network(object):
         p: probability computed by mcts for board
         z: winner of the game
         """
+        if self.inference:
+            raise RuntimeError("inference only network can not be trained")
+        self.wait()
+        self.generation += 1
         with self._graph.as_default():
-            board = np.array(board.tolist())
-            p = np.array(p.tolist())
-            z = np.array(z.tolist())
             self._sess.run([self._optimizer],
                            feed_dict={self._state: board,
                                       self._train_p_mcts: p,
@@ -108,27 +224,27 @@ def fully_connected(flatten_input, units):
         bias_regularizer=regularizer)
     return fc
 
-def conv_layer(input, training):
+def conv_layer(input, training, filters=64):
     """
     Implementation of a convolutional layer with 64 filter (3x3),
     batch normalization and rectifier non linearity (reLU)
     """
 
     with tf.variable_scope('conv'):
-        conv = convolution(input=input, filters=64, ksize=3)
+        conv = convolution(input=input, filters=filters, ksize=3)
         bn = tf.layers.batch_normalization(conv, training=training)
         relu = tf.nn.relu(bn)
         return relu
 
-def res_layer(input, training, id):
+def res_layer(input, training, id, filters=64):
     """
     Implementation of a residual layer with 64 filter (3x3)
     """
     with tf.variable_scope('res_' + str(id) ) as scope:
-        conv = convolution(input=input, filters=64, ksize=3)
+        conv = convolution(input=input, filters=filters, ksize=3)
         bn = tf.layers.batch_normalization(conv, training=training)
         relu = tf.nn.relu(bn)
-        conv = convolution(input=relu, filters=64, ksize=3)
+        conv = convolution(input=relu, filters=filters, ksize=3)
         bn = tf.layers.batch_normalization(conv, training=training)
         skip = tf.add(bn, input)
         relu = tf.nn.relu(skip)
@@ -163,14 +279,48 @@ def policy_head(input, training):
         tanh = tf.nn.tanh(fc)
         return tanh
 
-def network(input, training):
-    layer = conv_layer(input, training)
-    for i in range(16):
-        layer = res_layer(layer, training, i)
+def network(input, training, blocks=16, filters=64):
+    """
+    tower of a convolutional layer and blocks residual layers of filters filters, then the two heads
+    a small tower is a fast student network (see reinforcement.distillation)
+    """
+    layer = conv_layer(input, training, filters)
+    for i in range(blocks):
+        layer = res_layer(layer, training, i, filters)
     policy = policy_head(layer, training)
     value = value_head(layer, training)
     return policy, value
 
+def inference_network(input, weights):
+    """
+    same outputs as network, for weights exported by Network.export
+    variables of the graph are named after weights, they are assigned by Network.set_weights
+    without batch normalization, training and loss nodes
+    """
+    weights = { name: tf.get_variable(name, value.shape, value.dtype, tf.zeros_initializer(), trainable=False)
+                for name, value in weights.items() }
+    def convolution(input, name, bn):
+        conv = tf.nn.conv2d(input, weights[name + "/kernel"], [1, 1, 1, 1], 'SAME')
+        relu = tf.nn.relu(tf.nn.bias_add(conv, weights[name + "/bias"]))
+        return relu * weights[bn + "/scale"] + weights[bn + "/shift"]
+
+    def fully_connected(input, name):
+        return tf.nn.bias_add(tf.matmul(input, weights[name + "/kernel"]), weights[name + "/bias"])
+
+    layer = tf.nn.relu(convolution(input, "conv/conv2d", "conv/batch_normalization"))
+    blocks = len([ name for name in weights if re.match(r"res_\d+/conv2d/kernel$", name) ])
+    for i in range(blocks):
+        scope = "res_" + str(i)
+        relu = tf.nn.relu(convolution(layer, scope + "/conv2d", scope + "/batch_normalization"))
+        bn = convolution(relu, scope + "/conv2d_1", scope + "/batch_normalization_1")
+        layer = tf.nn.relu(bn + layer)
+    relu = tf.nn.relu(convolution(layer, "policy_head/conv2d", "policy_head/batch_normalization"))
+    policy = tf.nn.tanh(fully_connected(tf.reshape(relu, [-1, 19 * 19 * 2]), "policy_head/dense"))
+    relu = tf.nn.relu(convolution(layer, "value_head/conv2d", "value_head/batch_normalization"))
+    fc = tf.nn.relu(fully_connected(tf.reshape(relu, [-1, 19 * 19 * 1]), "value_head/dense"))
+    value = tf.nn.tanh(fully_connected(fc, "value_head/dense_1"))[:, 0]
+    return policy, value
+
 def loss_function(state, p_head, v_head):
 
     with tf.variable_scope('loss'):
@@ -2,64 +2,216 @@
 
 """
 class node, implement a level of deepness in a certain path for the monte carlo tree search
+nodes are handles over a tree, a struct of arrays holding the statistics of every node
 """
 
+import threading
 import numpy as np
 
+class TranspositionTable(object):
+    """
+    positions already expanded in a tree, keyed by (zobrist hash, player to move)
+    a node reaching a known position by another path shares the children of the stored node,
+    statistics of the edges stay on each path, so back propagation only updates the path taken
+    """
+    # approximate memory of an entry in the dict
+    ENTRY_SIZE = 200
+
+    def __init__(self):
+        """
+        initialize object
+        """
+        self._entries = dict()
+        self.hits = 0
+
+    def link(self, node, key):
+        """
+        if key is known, share its children with node and return its value, else return None
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self.hits += 1
+        node.share_children(entry[0])
+        return entry[1]
+
+    def store(self, key, node, value):
+        """
+        remember expanded node and its value for key
+        """
+        self._entries[key] = (node.get_index(), value)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def nbytes(self):
+        """
+        approximate memory used by the table
+        """
+        return len(self._entries) * self.ENTRY_SIZE
+
+class Tree(object):
+    """
+    struct of arrays storing every node of a search tree
+    children of node i are contiguous, from offset[i] to offset[i] + count[i]
+    lock must be held when the tree is shared between threads
+    with transposition, nodes of a same position share their children (the tree becomes a DAG)
+    """
+    def __init__(self, capacity=4096, transposition=False):
+        """
+        preallocate arrays for capacity nodes
+        """
+        self.lock = threading.Lock()
+        self.table = TranspositionTable() if transposition else None
+        self.size = 0
+        self.value = np.zeros(capacity, np.float64)
+        self.frequency = np.zeros(capacity, np.int32)
+        self.probability = np.zeros(capacity, np.float32)
+        self.offset = np.zeros(capacity, np.int32)
+        self.count = np.zeros(capacity, np.int16)
+
+    def allocate(self, probabilities):
+        """
+        append a contiguous block of nodes with given probabilities
+        return index of the first node of the block
+        """
+        n = len(probabilities)
+        if self.size + n > len(self.value):
+            self._resize(max(self.size + n, 2 * len(self.value)))
+        start = self.size
+        self.probability[start:start + n] = probabilities
+        self.size += n
+        return start
+
+    def _resize(self, capacity):
+        """
+        reallocate arrays for capacity nodes, keep existing nodes
+        """
+        for name in ('value', 'frequency', 'probability', 'offset', 'count'):
+            old = getattr(self, name)
+            new = np.zeros(capacity, old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def copy(self, index):
+        """
+        return a new tree holding only node index and its descendants, node index first
+        blocks of children shared by transposition are copied once and stay shared
+        """
+        tree = Tree(transposition=self.table is not None)
+        tree.allocate(self.probability[index:index + 1])
+        tree.value[0], tree.frequency[0] = self.value[index], self.frequency[index]
+        # copied expanded nodes and children blocks, old index => new index
+        nodes, blocks = dict(), dict()
+        stack = [ (index, 0) ]
+        while stack:
+            old, new = stack.pop()
+            count = int(self.count[old])
+            if not count:
+                continue
+            nodes[old] = new
+            offset = int(self.offset[old])
+            if offset not in blocks:
+                start = tree.allocate(self.probability[offset:offset + count])
+                tree.value[start:start + count] = self.value[offset:offset + count]
+                tree.frequency[start:start + count] = self.frequency[offset:offset + count]
+                blocks[offset] = start
+                stack.extend((offset + i, start + i) for i in range(count))
+            tree.offset[new], tree.count[new] = blocks[offset], count
+        if self.table is not None:
+            tree.table._entries = { key: (nodes[node], value)
+                                    for key, (node, value) in self.table._entries.items() if node in nodes }
+        # no spare capacity, nbytes is the memory of the subtree
+        tree._resize(tree.size)
+        return tree
+
+    def nbytes(self):
+        """
+        memory used by the arrays and the transposition table
+        """
+        table = 0 if self.table is None else self.table.nbytes()
+        return table + sum(getattr(self, name).nbytes
+                           for name in ('value', 'frequency', 'probability', 'offset', 'count'))
+
 class Node(object):
     """
-    node object
+    node object, index of a node in a tree
     """
-    def __init__(self, probability):
+    __slots__ = ('_tree', '_index')
+
+    def __init__(self, probability, tree=None, index=None):
         """
         initialize object
+        without tree, create the root of a new tree
         """
-        self._value = 0
-        self._frequency = 0
-        self._probability = probability
-        self._children = dict()
+        if tree is None:
+            tree = Tree()
+        if index is None:
+            index = tree.allocate([probability])
+        self._tree = tree
+        self._index = index
+
+    def get_tree(self):
+        """
+        getter
+        """
+        return self._tree
+
+    def get_index(self):
+        """
+        getter
+        """
+        return self._index
 
     def get_value(self):
         """
         getter
         """
-        return self._value
+        return self._tree.value[self._index]
 
     def get_frequency(self):
         """
         getter
         """
-        return self._frequency
+        return self._tree.frequency[self._index]
 
     def score(self, value):
         """
         update value
         """
-        self._value += value
+        self._tree.value[self._index] += value
 
     def add_frequency(self):
         """
         update score
         """
-        self._frequency += 1
+        self._tree.frequency[self._index] += 1
 
     def leaf(self):
         """
         check if node has been explored
         """
-        return not any(self._children)
+        return not self._tree.count[self._index]
 
     def get_score(self):
         """
         getter
         """
-        return 0 if not self._frequency else self._value / self._frequency
+        frequency = self.get_frequency()
+        return 0 if not frequency else self.get_value() / frequency
 
     def get_probability(self):
         """
         return probability / (1 + frequency)
         """
-        return self._probability / (1 + self._frequency)
+        return self._tree.probability[self._index] / (1 + self.get_frequency())
+
+    def _children(self):
+        """
+        return slice of children in tree arrays
+        """
+        start = self._tree.offset[self._index]
+        return slice(start, start + self._tree.count[self._index])
 
     def get_policy(self):
         """
@@ -67,39 +219,68 @@ class Node(object):
         Q => value / frequency
         U => probability / 1 + frequency
         """
-        return np.array([ node.get_score() + node.get_probability()
-                          for _, node in self._children.items() ])
+        children = self._children()
+        frequency = self._tree.frequency[children]
+        q = self._tree.value[children] / np.maximum(frequency, 1)
+        return q + self._tree.probability[children] / (1 + frequency)
+
+    def get_frequencies(self):
+        """
+        return array of children frequency
+        """
+        return self._tree.frequency[self._children()]
+
+    def select_child(self, sign):
+        """
+        return number of child maximizing Q + U for player sign (1 white, -1 black)
+        """
+        return np.argmax(self.get_policy() * sign)
 
     def expand_children(self, p):
         """
-        initialize children dict with array of probabilities
+        initialize children block with array of probabilities
         """
-        self._children = { n: Node(v) for n, v in enumerate(p) }
+        offset = self._tree.allocate(p)
+        self._tree.offset[self._index] = offset
+        self._tree.count[self._index] = len(p)
+
+    def share_children(self, index):
+        """
+        use children block of node index as children
+        """
+        self._tree.offset[self._index] = self._tree.offset[index]
+        self._tree.count[self._index] = self._tree.count[index]
 
     def get_child(self, nb_child):
         """
         return child node
         """
-        return self._children[nb_child]
+        return Node(None, self._tree, self._tree.offset[self._index] + nb_child)
+
+    def compact(self):
+        """
+        return this node as the root of a new tree without the rest of its tree (abandoned siblings)
+        """
+        return Node(None, self._tree.copy(self._index), 0)
 
     def get_max_frequency_move(self):
         """
         return max visited node
         """
-        return np.argmax( [ node.get_frequency() for _, node in self._children.items() ] )
+        return np.argmax(self.get_frequencies())
 
     def debug(self):
-        print ( [ node.get_frequency() for _, node in self._children.items() ] )
-        
+        print (self.get_frequencies().tolist())
+
         return
         print ("score")
-        print ( [ node.get_score() for _, node in self._children.items() ] )
+        print ( [ self.get_child(n).get_score() for n in range(len(self.get_frequencies())) ] )
         print ("len children")
-        print (len(self._children))
-        print ( np.sum( [ node.get_frequency() for _, node in self._children.items() ] ) )
+        print (len(self.get_frequencies()))
+        print ( np.sum( self.get_frequencies() ) )
 
     def __str__(self):
         """
         print object's value
         """
-        return '{}({})'.format(self.__class__.__name__, self._value)
+        return '{}({})'.format(self.__class__.__name__, self.get_value())
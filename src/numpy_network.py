@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""
+forward pass of the policy / value network with numpy only
+loads a model exported by network.Network.export, without tensorflow
+convolutions are im2col patches multiplied by the kernels (one GEMM per layer over the batch)
+"""
+
+import glob
+import os
+import re
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+def export_path(version, name="model"):
+    """
+    file of the inference only model of version
+    name: name of the network, "student" for a distilled network
+    """
+    prefix = "" if name == "model" else name + "-"
+    return "../models/" + prefix + "inference-" + str(version) + ".npz"
+
+def latest_export(name="model"):
+    """
+    return highest exported version of network name, None if there is none
+    """
+    prefix = "" if name == "model" else name + "-"
+    versions = [ int(match.group(1)) for match in
+                 (re.match(re.escape(prefix) + r"inference-(\d+)\.npz$", os.path.basename(path))
+                  for path in glob.glob("../models/" + prefix + "inference-*.npz")) if match ]
+    return max(versions) if versions else None
+
+def im2col(x, ksize):
+    """
+    return patches (n * 19 * 19, ksize * ksize * channels) of x (n, 19, 19, channels), 'SAME' padding
+    patch values are ordered like a tensorflow kernel (ky, kx, channel)
+    """
+    n, h, w, c = x.shape
+    if ksize == 1:
+        return x.reshape((n * h * w, c))
+    pad = ksize // 2
+    padded = np.zeros((n, h + 2 * pad, w + 2 * pad, c), x.dtype)
+    padded[:, pad:pad + h, pad:pad + w] = x
+    s = padded.strides
+    windows = as_strided(padded, (n, h, w, ksize, ksize, c), (s[0], s[1], s[2], s[1], s[2], s[3]))
+    return windows.reshape((n * h * w, ksize * ksize * c))
+
+class NumpyNetwork(object):
+    """
+    inference only network with the infer / infer_batch interface of Network
+    """
+    def __init__(self, version, name="model", weights=None):
+        """
+        load exported weights of network name of version
+        weights: dict of exported weights to use instead of the file
+        """
+        self.version = version
+        self.name = name
+        # weights never change, see cache.EvalCache
+        self.generation = 0
+        if weights is not None:
+            self._weights = dict(weights)
+        else:
+            with np.load(export_path(version, name=name)) as f:
+                self._weights = { name: f[name] for name in f.files }
+        self._weights = { key: value.astype(np.float32) for key, value in self._weights.items() }
+        self._blocks = len([ name for name in self._weights if re.match(r"res_\d+/conv2d/kernel$", name) ])
+
+    def _convolution(self, x, name, bn):
+        """
+        convolution name with relu, followed by folded batch normalization bn
+        """
+        kernel = self._weights[name + "/kernel"]
+        n = len(x)
+        out = np.dot(im2col(x, kernel.shape[0]), kernel.reshape((-1, kernel.shape[-1])))
+        out += self._weights[name + "/bias"]
+        np.maximum(out, 0, out)
+        out *= self._weights[bn + "/scale"]
+        out += self._weights[bn + "/shift"]
+        return out.reshape((n, 19, 19, -1))
+
+    def _fully_connected(self, x, name):
+        return np.dot(x, self._weights[name + "/kernel"]) + self._weights[name + "/bias"]
+
+    def infer(self, board):
+        """
+        infer policy and value from board state
+        """
+        return self.infer_batch(board[None, :])
+
+    def infer_batch(self, boards):
+        """
+        infer policies and values from a batch of board states (n, 19, 19, 3)
+        """
+        n = len(boards)
+        layer = np.maximum(self._convolution(np.asarray(boards, np.float32), "conv/conv2d",
+                                             "conv/batch_normalization"), 0)
+        for i in range(self._blocks):
+            scope = "res_" + str(i)
+            relu = np.maximum(self._convolution(layer, scope + "/conv2d", scope + "/batch_normalization"), 0)
+            bn = self._convolution(relu, scope + "/conv2d_1", scope + "/batch_normalization_1")
+            layer = np.maximum(bn + layer, 0)
+        relu = np.maximum(self._convolution(layer, "policy_head/conv2d", "policy_head/batch_normalization"), 0)
+        policy = np.tanh(self._fully_connected(relu.reshape((n, -1)), "policy_head/dense"))
+        relu = np.maximum(self._convolution(layer, "value_head/conv2d", "value_head/batch_normalization"), 0)
+        fc = np.maximum(self._fully_connected(relu.reshape((n, -1)), "value_head/dense"), 0)
+        value = np.tanh(self._fully_connected(fc, "value_head/dense_1"))[:, 0]
+        return policy, value
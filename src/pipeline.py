@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+input pipeline of the training
+background threads sample, augment and convert batches while the network trains on the previous one
+"""
+
+import threading
+import queue
+import numpy as np
+from utils_board import random_symmetries
+
+class Prefetcher(object):
+    """
+    iterate over number_batches ready to feed float32 batches (states, policies, outcomes)
+    prepared by workers threads into a queue of at most depth batches
+    """
+    def __init__(self, labels, batch_size, number_batches, workers=2, depth=4):
+        """
+        labels: object with a sample(batch_size) method, like labels.ReplayBuffer
+        """
+        self._labels = labels
+        self._batch_size = batch_size
+        self._number_batches = number_batches
+        self._remaining = number_batches
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._queue = queue.Queue(depth)
+        self._threads = [ threading.Thread(target=self._produce, daemon=True) for _ in range(workers) ]
+        for thread in self._threads:
+            thread.start()
+
+    def _prepare(self):
+        """
+        return one random, augmented batch converted to float32
+        """
+        states, policies, outcomes = self._labels.sample(self._batch_size)
+        states, policies = random_symmetries(states, policies)
+        return (states.astype(np.float32), policies.astype(np.float32, copy=False),
+                outcomes.astype(np.float32))
+
+    def _put(self, item):
+        """
+        put item in queue, give up if stopped
+        """
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _produce(self):
+        """
+        worker loop, prepare batches until number_batches are produced
+        """
+        while not self._stop.is_set():
+            with self._lock:
+                if self._remaining <= 0:
+                    return
+                self._remaining -= 1
+            try:
+                item = self._prepare()
+            except Exception as e:
+                item = e
+            self._put(item)
+
+    def __iter__(self):
+        """
+        yield batches as soon as they are ready, raise errors of workers
+        """
+        try:
+            for _ in range(self._number_batches):
+                item = self._queue.get()
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        stop workers
+        """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
@@ -8,58 +8,220 @@ piskvork is a program made for gomoku tournament
 import numpy as np
 import threading
 import os
-from mcts import mcts, expand
+import sys
+from mcts import mcts, expand, search, search_parallel
+from numpy_network import NumpyNetwork, export_path, latest_export
 from protocol import Protocol
 from node import Node
+from search_stats import SearchStats
+from state import State
+from time_control import SearchBudget, TimeManager
+from utils_board import put_on_board, get_child_number
+
+# minimum memory of the search tree, in bytes
+MIN_TREE_MEMORY = 16 * 2**20
 
 class Thread(threading.Thread):
+    """
+    read commands of piskvork and queue them for the engine, until END or end of input
+    """
     def __init__(self, protocol):
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, daemon=True)
         self.protocol = protocol
 
     def run(self):
         while self.protocol.running[0]:
             self.protocol.nextCmd()
 
-def play_turn(board, player, network):
-    print("DEBUG", "Calculating the next move")
-    node = Node(0)
-    expand(node, board, player, network)
-    (x, y), _, _, _, _ = mcts(board, player, node, network)
-    print("%d,%d" % (int(x), int(y)))
+class Engine(object):
+    """
+    state of the engine between commands, the search tree is kept from turn to turn
+    while the opponent thinks, the engine keeps searching its tree (pondering)
+    """
+    def __init__(self, network, infos, player=0, ponder=True, stats=False, threads=1):
+        """
+        network: evaluation of positions, infos: Protocol.infos, player: our layer of the board
+        stats: print the search stats of each move (see search_stats.SearchStats)
+        threads: number of threads searching the tree, for moves and pondering (see mcts.search_parallel)
+        """
+        self.network = network
+        self.infos = infos
+        self.timer = TimeManager(infos)
+        self.player = player
+        self.ponder = ponder
+        self.stats = stats
+        self.threads = threads
+        self._pondering = None
+        self._stop = threading.Event()
+        # playouts of the last pondering
+        self.ponder_playouts = 0
+        self.reset()
+
+    def _memory_full(self):
+        """
+        true if the tree uses more than half of max_memory (bytes, 0 or missing: no limit)
+        a limit below MIN_TREE_MEMORY can not be met by the interpreter itself, the tree may then use that much
+        """
+        max_memory = int(self.infos.get("max_memory", 0))
+        return bool(max_memory) and self.root is not None \
+            and self.root.get_tree().nbytes() > max(max_memory // 2, MIN_TREE_MEMORY)
+
+    def _fit_memory(self):
+        """
+        when the tree is too big, keep only the subtree of root in a new tree, drop it if even that is too big
+        """
+        if not self._memory_full():
+            return
+        self.root = self.root.compact()
+        print("DEBUG", "Compacted tree to", self.root.get_tree().nbytes(), "bytes")
+        if self._memory_full():
+            self.root = None
+
+    def _search(self, player):
+        """
+        pondering loop, search tree of root until stopped or out of memory
+        an error is logged, board is restored and the tree dropped, the engine keeps playing
+        """
+        board = np.copy(self.board)
+        budget = SearchBudget(stop=lambda: self._stop.is_set() or self._memory_full())
+        try:
+            if self.root.leaf():
+                expand(self.root, self.board, player, self.network, self.state)
+            # stop at the limit, the tree is compacted to the subtree of the next move (see play_turn)
+            if self.threads > 1:
+                search_parallel(self.root, self.board, player, self.network, budget, self.threads)
+            else:
+                while budget.take(self.root):
+                    search(self.root, self.board, player, self.network, self.state)
+        except Exception as e:
+            print("DEBUG", "Pondering failed:", repr(e))
+            self.board[:] = board
+            self.state = State(self.board)
+            self.root = None
+        self.ponder_playouts = budget.done()
+
+    def start_pondering(self):
+        """
+        search the position after our move in background, until stop_pondering
+        """
+        if not self.ponder or self.root is None:
+            return
+        self._fit_memory()
+        if self.root is None:
+            return
+        self._stop.clear()
+        self._pondering = threading.Thread(target=self._search, args=(self.player ^ 1,), daemon=True)
+        self._pondering.start()
+
+    def stop_pondering(self):
+        """
+        stop background search, board and tree are left ready for the next command
+        """
+        if self._pondering is None:
+            return
+        self._stop.set()
+        self._pondering.join()
+        self._pondering = None
+        print("DEBUG", "Pondered", self.ponder_playouts, "playouts")
+
+    def reset(self, moves=()):
+        """
+        new position (START, RESTART, BOARD), previous search tree is dropped
+        moves: list of (x, y, player)
+        """
+        self.board = np.zeros((19, 19, 3), np.int8)
+        self.state = State(self.board)
+        for x, y, player in moves:
+            put_on_board(self.board, (x, y), player, 1, self.state)
+        self.root = None
+
+    def opponent_move(self, pos):
+        """
+        put opponent move on board, the matching subtree becomes the root
+        """
+        if self.root is not None and not self.root.leaf():
+            self.root = self.root.get_child(get_child_number(self.board, pos, self.state))
+        else:
+            self.root = None
+        put_on_board(self.board, pos, self.player ^ 1, 1, self.state)
+
+    def play_turn(self):
+        """
+        search next move until the deadline given by timer, print it
+        the subtree of the move is kept as root for the next turn
+        """
+        print("DEBUG", "Calculating the next move")
+        deadline = self.timer.deadline(self.board)
+        if self.root is not None:
+            self._fit_memory()
+        if self.root is None or self.root.leaf():
+            self.root = Node(0)
+            expand(self.root, self.board, self.player, self.network, self.state)
+        else:
+            print("DEBUG", "Reusing", int(np.sum(self.root.get_frequencies())), "playouts")
+        stats = SearchStats() if self.stats else None
+        (x, y), _, _, self.root, status = mcts(self.board, self.player, self.root, self.network,
+                                               trials=None, threads=self.threads, state=self.state,
+                                               deadline=deadline, stats=stats)
+        print("%d,%d" % (int(x), int(y)))
+        if stats is not None:
+            print("DEBUG", stats)
+        if not status:
+            self.start_pondering()
+
+def load_network(version=None):
+    """
+    numpy network if version was exported: fast start and no tensorflow, else tensorflow network
+    version: None for the latest exported version, new random network if none was exported
+    """
+    if version is None:
+        version = latest_export()
+        if version is None:
+            version = -1
+    if os.path.isfile(export_path(version)):
+        return NumpyNetwork(version)
+    from network import Network
+    return Network(version, inference=True, logs=False)
 
 def piskvork_game():
     """
     play gomoku game using trained model and piskvork interface
     """
-    board = np.zeros((19, 19, 3), np.int8)
+    # piskvork reads answers line by line
+    sys.stdout = os.fdopen(sys.stdout.fileno(), "w", 1)
     running = [1]
-    protocol = Protocol(board, running)
+    protocol = Protocol(running, os.fdopen(sys.stdin.fileno(), "r", 1))
     thread = Thread(protocol)
-    network = Network(-1)
-    player = 0
+    # every core searches the tree of each move
+    engine = Engine(load_network(), protocol.infos, threads=os.cpu_count() or 1)
 
     thread.start()
-    while running[0]:
-        args = protocol.pullCmd();
+    while True:
+        args = protocol.pullCmd()
         cmd = args[0].lower()
         del args[0]
-        if cmd == "none":
-            pass
-        elif cmd == "start":
+        engine.stop_pondering()
+        if cmd == "end":
+            break
+        elif cmd in ("start", "restart"):
+            engine.reset()
             print("OK")
         elif cmd == "turn":
             try:
                 pos = args[0].split(',')
-                x = int(pos[0])
-                y = int(pos[1])
-                mc_tree_search.put_on_board(board, (x, y), player ^ 1, 0)
+                engine.opponent_move((int(pos[0]), int(pos[1])))
             except:
                 print("ERROR")
-            play_turn(board, player, network)
+            engine.play_turn()
         elif cmd == "begin":
-            play_turn(board, player, network)
-            pass
+            engine.play_turn()
+        elif cmd == "board":
+            # own stones (1) on our layer, opponent stones (2) on the other
+            moves = [ tuple(map(int, move.split(','))) for move in args ]
+            engine.reset([ (x, y, engine.player if p == 1 else engine.player ^ 1)
+                           for x, y, p in moves if p in (1, 2) ])
+            if moves and moves[-1][2] == 2:
+                engine.play_turn()
         else:
             print("ERROR")
     thread.join()
@@ -1,28 +1,46 @@
-import mcts
+import sys
+import queue
 
 class Protocol:
-    def __init__(self, b, r):
+    def __init__(self, r, stream=sys.stdin):
         self.infos = {"timeout_turn": 4000, "timeout_match": 0, "max_memory": 70000,
          "time_left": 2147483647, "game_type": 1, "rule": 1,
          "evaluate": [0, 0], "folder": "/tmp/"}
-        self.board = b
         self.running = r
-        self.cmdTab = []
+        self.stream = stream
+        # commands for the engine thread, "end" is always the last one
+        self.cmdTab = queue.Queue()
+
+    def readLine(self):
+        line = self.stream.readline()
+        if not line:
+            # input closed, same as END
+            raise EOFError
+        return line.rstrip("\r\n")
+
+    def end(self):
+        self.running[0] = 0
+        self.cmdTab.put("end")
 
     def nextCmd(self):
-        line = input()
-        line = line[:-1] if line[-1:] == "\n" else line
+        try:
+            line = self.readLine()
+        except EOFError:
+            self.end()
+            return
         args = line.split(' ')
         cmd = args[0].lower()
         del args[0]
         if cmd == "board":
             new_board = []
-            inp = input()
-            inp = inp[:-1] if inp[-1:] == "\n" else inp
-            while inp.lower() != "done":
-                new_board.append(inp)
-                inp = input()
-                inp = inp[:-1] if inp[-1:] == "\n" else inp
+            try:
+                inp = self.readLine()
+                while inp.lower() != "done":
+                    new_board.append(inp)
+                    inp = self.readLine()
+            except EOFError:
+                self.end()
+                return
             moves = []
             for line in new_board:
                 move = line.split(',')
@@ -38,17 +56,10 @@ class Protocol:
                     print("ERROR")
                     break
                 moves.append(pos)
-            lastMove = 0
             for move in moves:
-                x = move[0];
-                y = move[1];
-                player = move[2] % 2; # map 2 -> 0 and 1 -> 1
-                put_on_board(self.board, (x, y), player, 0)
-                # self.board[0][move[1]][move[0]] = move[2]
                 print("DEBUG", "Player", move[2], ":", move[0], move[1])
-                lastMove = move[2]
-            if lastMove == 2:
-                self.cmdTab.append("begin")
+            # the engine sets up the position, and plays if the opponent moved last
+            self.cmdTab.put(" ".join([ "board" ] + [ "%d,%d,%d" % tuple(move) for move in moves ]))
         elif cmd == "info":
             try:
                 if args[0].lower() in self.infos:
@@ -57,16 +68,12 @@ class Protocol:
             except:
                 print("ERROR")
         elif cmd == "end":
-            self.running[0] = 0
+            self.end()
         elif cmd == "about":
             print('name="Alpha", version="2.0", author="DreamTeam", country="France"')
         else:
-            self.cmdTab.append(line)
+            self.cmdTab.put(line)
 
     def pullCmd(self):
-        try:
-            cmd = self.cmdTab[0].split(' ')
-            del self.cmdTab[0]
-            return cmd
-        except:
-            return ["none"]
+        # wait without using the cpu until a command arrives
+        return self.cmdTab.get().split(' ')
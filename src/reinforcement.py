@@ -2,107 +2,113 @@
 
 """
 play a game against oneself until the end
-save labels (state, policy, winning) to file label_{num_game}.label
+save games (start, moves, visit counts, winning) to label shards of directory labels_{version}
 train network from batches of labels
 """
 
 import os
+import glob
+import multiprocessing
 import numpy as np
-import random as rd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cache import EvalCache
+from inference_server import InferenceServer
+from labels import LabelWriter, ReplayBuffer, label_directory
+from pipeline import Prefetcher
 from mcts import mcts, expand
-from node import Node
-from network import Network
-from utils_board import init_map, print_board
+from node import Node, Tree
+from search_stats import SearchStats
+from state import State
+from utils_board import init_map, print_board, get_child_number, get_empty_tiles, policy_distribution
 
-def save_tmp_label(turns, board, p, player):
+def save_tmp_label(turns, pos, tiles, visits, player):
     """
-    append board, policy vector and current player to tmp file
-    shape: ( (19, 19, 3), (361), (1) )
+    append move, sparse visit counts of the children and current player to the game record
+    tiles: tile of each child (empty tiles before the move), visits: visit count of each child
     """
-    turns.append((board, p, player))
+    visited = np.flatnonzero(visits)
+    turns.append((pos[1] * 19 + pos[0], tiles[visited], visits[visited], player))
 
-def save_final_label(turns, winner, filename):
+def save_final_label(labels, winner, writer):
     """
-    rewrite tmp file and change player to 1 if == winner, else -1
+    append game record (start, turns) to the shard of writer, outcome is 1 if player == winner, else -1
     """
-    turns = list(map(lambda x: (x[0], x[1], 1 if x[2] == winner else -1), turns))
-    if os.path.exists(filename):
-        turns += list(np.load(filename))
-    np.save(filename, np.array(turns))
+    start, turns = labels
+    writer.append(start,
+                  [ move for move, _, _, _ in turns ],
+                  [ player for _, _, _, player in turns ],
+                  [ 1 if player == winner else -1 for _, _, _, player in turns ],
+                  [ tiles for _, tiles, _, _ in turns ],
+                  [ visits for _, _, visits, _ in turns ])
 
-def init_game(network_1, network_2):
+def init_game(network_1, network_2, transposition=False, start=None):
     """
     init game board, first node, next player turn
+    transposition: share subtrees of identical positions in each player tree
+    start: starting board, init_map() if None
     """
-    board = init_map()
+    board = init_map() if start is None else np.copy(start)
     # board = np.zeros((19, 19, 3), np.int8)
     # player 1
-    node_p_1 = Node(0)
+    node_p_1 = Node(0, Tree(transposition=transposition))
     expand(node_p_1, board, 0, network_1)
     # player 2
-    node_p_2 = Node(0)
+    node_p_2 = Node(0, Tree(transposition=transposition))
     expand(node_p_2, board, 1, network_2)
     return board, node_p_1, node_p_2
 
-def update_turn(board, player, node, network, pos):
+def update_turn(board, player, node, network, pos, state=None):
     """
     take board, player number, current node, player network and opponent move
     return child node according to opponent move
     """
     # get child from number of empty moves before opponent move
-    complete_board = (board[:,:,0] + board[:,:,1]).flatten()
-    child = node.get_child(np.sum((complete_board[:(pos[1] * 19 + pos[0])] == 0)))
+    child = node.get_child(get_child_number(board, pos, state))
     # if unexplored yet
     if child.leaf():
-        expand(child, board, player, network)
+        expand(child, board, player, network, state)
     return child
 
-def sequence(board, player, p_node, p_net, o_node, o_net, labels):
+def sequence(board, player, p_node, p_net, o_node, o_net, labels, state=None, log=None):
     """
     perform a complete turn
     take state info, player objects, and save boolean
+    log: GameLog receiving the search stats of the turn, None to disable
     return game status (O, 1), updated current and opponent nodes
     """
-    pos, board, p, p_node, status = mcts(board, player, p_node, p_net)
-    o_node = update_turn(board, player ^ 1, o_node, o_net, pos)
-    save_tmp_label(labels, board, p, player)
+    root, tiles = p_node, np.flatnonzero(get_empty_tiles(board, state))
+    stats = None if log is None else SearchStats()
+    pos, board, p, p_node, status = mcts(board, player, p_node, p_net, state=state, stats=stats)
+    o_node = update_turn(board, player ^ 1, o_node, o_net, pos, state)
+    save_tmp_label(labels, pos, tiles, root.get_frequencies(), player)
+    if log is not None:
+        log.write(stats, turn=len(labels) - 1, player=player, move=[ int(pos[0]), int(pos[1]) ])
     #print_board(board)
     return status, p_node, o_node
 
-def game(net_1, net_2):
+def game(net_1, net_2, transposition=False, start=None, log=None):
     """
     take identifier of a game and play it until the end
-    num_game: integer
+    log: GameLog receiving the search stats of every turn
+    return game record (starting board, turns) and winner
     """
-    board, p_1, p_2 = init_game(net_1, net_2)
+    board, p_1, p_2 = init_game(net_1, net_2, transposition, start)
+    state = State(board)
+    start = np.copy(board)
     labels = []
     while (True):
-        status, p_1, p_2 = sequence(board, 0, p_1, net_1, p_2, net_2, labels)
+        status, p_1, p_2 = sequence(board, 0, p_1, net_1, p_2, net_2, labels, state, log)
         if status:
-            return labels, 0
-        status, p_2, p_1 = sequence(board, 1, p_2, net_2, p_1, net_1, labels)
+            return (start, labels), 0
+        status, p_2, p_1 = sequence(board, 1, p_2, net_2, p_1, net_1, labels, state, log)
         if status:
-            return labels, 1
+            return (start, labels), 1
 
-def random_rotation(s, p, z):
+def get_version():
     """
-    apply random rotation on label
+    champion version: 1 + number of versions having labels
     """
-    r = rd.randint(0, 3)
-    s[:,:,0] = np.rot90(s[:,:,0], r, (0, 1))
-    s[:,:,1] = np.rot90(s[:,:,1], r, (0, 1))
-    p = np.rot90(p.reshape((19, 19)), r, (0, 1)).flatten()
-    return (s, p, z)
-
-def get_training_labels(version, size):
-    """
-    size labels from the most recent ones
-    """
-    labels = []
-    while (len(labels) < size and version > 0):
-        labels += list(np.load("../labels/labels_" + str(version) + ".npy"))
-        version -= 1
-    return labels
+    return len(glob.glob(label_directory("*"))) + 1
 
 def evaluation(number_games, champion, trainee):
     """
@@ -116,73 +122,176 @@ def evaluation(number_games, champion, trainee):
         win += winner
     return win / number_games * 100
 
-def training(number_training, batch_size, size_train_labels, version, trainee):
+def training(number_training, batch_size, size_train_labels, version, trainee, recency=0):
     """
     take number_training, version and trainee
-    train on label
+    train on labels of a memory mapped window of size_train_labels labels
+    recency: 0 for uniform sampling, else more recent versions are sampled more
     """
-    labels = get_training_labels(version, size_train_labels)
-    for i in range(number_training):
+    labels = ReplayBuffer(version, size_train_labels, recency)
+    if not len(labels):
+        return
+    # random batches with random transformation, prepared in background
+    batches = Prefetcher(labels, min(batch_size, len(labels)), number_training)
+    for i, (states, policies, outcomes) in enumerate(batches):
         print(i, end=" ", flush=True)
 
-        # random batch
-        batch = rd.sample(labels, min(batch_size, len(labels)))
-
-        # random transformation
-        batch = [ random_rotation(s, p, z) for s, p, z in batch ]
-
         # training
-        batch = np.array(batch)
-        trainee.train(batch[:,0], batch[:,1], batch[:,2])
+        trainee.train(states, policies, outcomes)
 
-    del labels
+def distillation(number_training, batch_size, size_train_labels, version, teacher, student):
+    """
+    fit student to the policies and values of teacher on stored positions
+    teacher policies are turned into distributions over empty tiles, its values are the targets
+    """
+    labels = ReplayBuffer(version, size_train_labels)
+    if not len(labels):
+        return
+    batches = Prefetcher(labels, min(batch_size, len(labels)), number_training)
+    for i, (states, _, _) in enumerate(batches):
+        print(i, end=" ", flush=True)
+        policies, values = teacher.infer_batch(states)
+        student.train(states, policy_distribution(states, policies), values)
 
-def self_play(number_games, player, version):
+def self_play(number_games, player, version, threads=1):
     """
     take number_games version, and produce labels
+    player: network playing, its evaluations are cached (see cache.EvalCache)
+    threads: number of games played at the same time, their boards are evaluated in shared batches
     """
-    path_label = "../labels/labels_" + str(version) + ".npy"
-    for i in range(number_games):
-        print(i, end=" ", flush=True)
-        tmp_labels, winner = game(player, player)
-        save_final_label(tmp_labels, winner, path_label)
+    writer = LabelWriter(label_directory(version), "main")
+    if threads > 1:
+        # cache in front of the server: hits are answered at once, with the incremental hashes of State
+        with InferenceServer(player, max_batch_size=threads) as server:
+            cache = EvalCache(server)
+            with ThreadPoolExecutor(threads) as executor:
+                games = [ executor.submit(game, cache, cache) for _ in range(number_games) ]
+                for i, future in enumerate(as_completed(games)):
+                    print(i, end=" ", flush=True)
+                    tmp_labels, winner = future.result()
+                    save_final_label(tmp_labels, winner, writer)
+            print ("\ninference server:", server.boards, "boards in", server.batches, "batches")
+    else:
+        cache = EvalCache(player)
+        for i in range(number_games):
+            print(i, end=" ", flush=True)
+            tmp_labels, winner = game(cache, cache)
+            save_final_label(tmp_labels, winner, writer)
+    writer.close()
+    print ("\ncache:", cache.stats())
+
+# network and label shard of a self play worker process
+_worker = dict()
+
+def _init_worker(version, name):
+    """
+    load weights of version once per worker process, each worker writes its own label shard
+    name: network playing, "model" or "student"
+    """
+    from network import Network
+    network = Network(version, inference=True, name=name)
+    _worker["network"] = EvalCache(network)
+    _worker["writer"] = LabelWriter(label_directory(version), str(os.getpid()))
+
+def _play_game(_):
+    """
+    play a self play game in a worker process, save it to the shard of the worker
+    return number of turns and winner
+    """
+    network = _worker["network"]
+    tmp_labels, winner = game(network, network)
+    save_final_label(tmp_labels, winner, _worker["writer"])
+    return len(tmp_labels[1]), winner
+
+def self_play_parallel(number_games, version, processes, name="model"):
+    """
+    take number_games version, and produce labels with a pool of processes
+    workers load the exported model name of version
+    """
+    turns, wins = 0, [ 0, 0 ]
+    # spawn: forking a process running tensorflow is unsafe
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes, _init_worker, (version, name)) as pool:
+        for i, (length, winner) in enumerate(pool.imap_unordered(_play_game, range(number_games))):
+            print(i, end=" ", flush=True)
+            turns += length
+            wins[winner] += 1
+    print ("\nself play:", number_games, "games,", turns, "turns, wins (white, black):", wins)
 
 def reinforcement():
     """
     train model against itself
     """
     number_games = 2
+    processes = 1
+    # games played at the same time by threads of a process, evaluated in shared batches
+    threads = 1
+    # residual blocks and filters of a student distilled from trainee for self play, 0: no student
+    student_blocks = 0
+    student_filters = 32
+    number_distillation = 2
     number_training = 2
     number_evaluation = 2
     batch_size = 2048
     size_train_labels = 50000
     epoch = 0
 
+    # tensorflow is only needed to train, games and labels work without it
+    from network import Network
+
     # get champion version
-    version = len(os.listdir("../labels/"))
+    version = get_version()
     trainee = Network(version)
-    champion = Network(version)
     trainee.save_session()
+    trainee.export(wait=True)
+    # the champion only plays, it loads the inference only model, then gets weights in memory
+    champion = Network(version, inference=True)
+    # self play is faster with the student, evaluation and tournaments use the full network
+    student = None
+    if student_blocks:
+        student = Network(version, name="student", blocks=student_blocks, filters=student_filters)
+    # labels are generated by the champion of version (or the student), whatever the number of processes:
+    # workers load the export of version, written when the trainee is promoted
+    player = student if student is not None else champion
 
     while (True):
         # produce labels from best version
-        print ("self play, number_games:", number_games, "version:", version)
-        self_play(number_games, trainee, version)
+        print ("self play, number_games:", number_games, "version:", version, "player:", player.name)
+        if processes > 1:
+            # workers load the export of version from disk
+            if student is not None:
+                student.version = version
+                student.export()
+            trainee.wait()
+            player.wait()
+            self_play_parallel(number_games, version, processes, player.name)
+        else:
+            self_play(number_games, player, version, threads)
 
         # cloned trainee learns from labels
         print ("\ntraining, number_training:", number_training, "version:", version)
         training(number_training, batch_size, size_train_labels, version, trainee)
 
-        # if trainee beats champion, trainee becomes champion, new trainee is cloned from it
+        # student imitates trainee
+        if student is not None:
+            print ("\ndistillation, number_distillation:", number_distillation, "version:", version)
+            distillation(number_distillation, batch_size, size_train_labels, version, trainee, student)
+
+        # if trainee beats champion, its weights are copied to champion, trainee keeps training
         print ("\nevaluation, number_evaluation:", number_evaluation)
-        score = evaluation(number_evaluation, champion, trainee)
+        score = evaluation(number_evaluation, EvalCache(champion), EvalCache(trainee))
         if score > 55:
             version += 1
+            trainee.version = version
+            champion.version = version
+            champion.set_weights(trainee.get_weights())
             trainee.save_session()
-            champion = Network(version)
-            trainee = Network(version)
+            trainee.export()
+            if student is not None:
+                student.version = version
+                student.save_session()
 
         epoch += 1
         print ("\nfinal evaluation score:", score, "actual version", version, " number of epoch", epoch)
 
-    trainee.save_session()
+    trainee.save_session(wait=True)
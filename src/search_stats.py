@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""
+instrumentation of the search
+counters and timers of each phase of the playouts of a move, and a per game log of them
+the search functions take a stats object, None disables instrumentation at the cost of a test
+"""
+
+import json
+import time
+
+PHASES = ("selection", "network", "win_check", "backup")
+
+class SearchStats(object):
+    """
+    counters and timers of the search of one move
+    """
+    def __init__(self):
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.counts = dict.fromkeys(PHASES, 0)
+        self.playouts = 0
+        self.evaluated = 0
+        self.max_depth = 0
+        # nodes allocated in the tree, all children of a node are allocated when it is expanded
+        self.tree_size = 0
+        self.nodes = 0
+        self.elapsed = 0.0
+        self._depth = 0
+        self._start = None
+        self._size = 0
+
+    def add(self, phase, start):
+        """
+        add time since start (time.perf_counter) to phase
+        """
+        self.times[phase] += time.perf_counter() - start
+        self.counts[phase] += 1
+
+    def select(self):
+        """
+        one more level in the current playout
+        """
+        self._depth += 1
+
+    def end_playout(self):
+        """
+        end of a playout, keep its depth
+        """
+        self.playouts += 1
+        self.max_depth = max(self.max_depth, self._depth)
+        self._depth = 0
+
+    def start(self, root):
+        """
+        start of the search of the move of root
+        """
+        self._start = time.perf_counter()
+        self._size = root.get_tree().size
+
+    def finish(self, root):
+        """
+        end of the search of the move of root
+        """
+        self.elapsed = time.perf_counter() - self._start
+        self.tree_size = root.get_tree().size
+        self.nodes = self.tree_size - self._size
+
+    def merge(self, other):
+        """
+        add counters and timers of other, the stats of another searching thread
+        """
+        for phase in PHASES:
+            self.times[phase] += other.times[phase]
+            self.counts[phase] += other.counts[phase]
+        self.playouts += other.playouts
+        self.evaluated += other.evaluated
+        self.max_depth = max(self.max_depth, other.max_depth)
+
+    def nodes_per_second(self):
+        return self.nodes / max(self.elapsed, 1e-9)
+
+    def playouts_per_second(self):
+        return self.playouts / max(self.elapsed, 1e-9)
+
+    def as_dict(self):
+        return { "playouts": self.playouts, "evaluated": self.evaluated, "max_depth": self.max_depth,
+                 "tree_size": self.tree_size, "nodes": self.nodes, "elapsed": self.elapsed,
+                 "nodes_per_second": self.nodes_per_second(),
+                 "playouts_per_second": self.playouts_per_second(),
+                 "times": dict(self.times), "counts": dict(self.counts) }
+
+    def __str__(self):
+        phases = " ".join("{} {:.3f}s/{}".format(phase, self.times[phase], self.counts[phase])
+                          for phase in PHASES)
+        return "{} playouts in {:.3f}s ({:.0f}/s), {} nodes ({:.0f}/s), tree {}, depth {}, {}".format(
+            self.playouts, self.elapsed, self.playouts_per_second(), self.nodes, self.nodes_per_second(),
+            self.tree_size, self.max_depth, phases)
+
+class GameLog(object):
+    """
+    append the stats of every move of games to a file, one json object per line
+    """
+    def __init__(self, path):
+        self._file = open(path, "a")
+
+    def write(self, stats, **fields):
+        """
+        log stats of a move, with fields (game, turn, player...)
+        """
+        record = stats.as_dict()
+        record.update(fields)
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
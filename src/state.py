@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+incremental informations about a board, kept up to date by put_on_board
+lines: per player bitboards of every row, column and diagonal, for O(1) win detection
+empty tiles: fenwick tree over empty tiles, to map number of child <=> position in O(log n)
+hashes: zobrist hash of the board under each of the 8 board symmetries
+"""
+
+import numpy as np
+from utils_board import INVERSE_SYMMETRIES
+
+# zobrist keys of each player on each tile
+ZOBRIST = np.random.RandomState(19).randint(0, 2**64, size=(2, 19 * 19), dtype=np.uint64)
+# keys of tile i in symmetry s: tile i is moved to INVERSE_SYMMETRIES[s][i]
+SYMMETRIC_ZOBRIST = [ [ tuple(int(ZOBRIST[player][INVERSE_SYMMETRIES[s][i]]) for s in range(8))
+                        for i in range(19 * 19) ] for player in (0, 1) ]
+
+def _line_tables():
+    """
+    for each tile, return the 4 lines going through it (row, column, diagonal, anti diagonal)
+    as (line id, bit of the tile, shift and mask of the 9 tiles window centered on the tile)
+    lines are numbered: rows 0-18, columns 19-37, diagonals 38-74, anti diagonals 75-111
+    """
+    tables = []
+    for i in range(19 * 19):
+        x, y = i % 19, i // 19
+        tile = []
+        # bit along a line: x for rows and diagonals, y for columns
+        for line, b in ((y, x), (19 + x, y), (38 + x - y + 18, x), (75 + x + y, x)):
+            shift = max(b - 4, 0)
+            tile.append((line, 1 << b, shift, (1 << (b + 5 - shift)) - 1))
+        tables.append(tuple(tile))
+    return tuple(tables)
+
+LINES = _line_tables()
+
+class State(object):
+    """
+    incremental informations about a board (19, 19, 3)
+    """
+    def __init__(self, board):
+        """
+        build informations from current board
+        """
+        self._lines = [ [ 0 ] * 112, [ 0 ] * 112 ]
+        self._hashes = [ 0 ] * 8
+        # bit 0 / 1 set if player 0 / 1 is on tile
+        self._tiles = [ 0 ] * 361
+        self._empty = np.ones(361, bool)
+        self._fenwick = [ 0 ] + [ 1 ] * 361
+        for i in range(1, 362):
+            parent = i + (i & -i)
+            if parent <= 361:
+                self._fenwick[parent] += self._fenwick[i]
+        for player in (0, 1):
+            for y, x in zip(*np.nonzero(board[:,:,player])):
+                self.update((x, y), player, 1)
+
+    def update(self, pos, player, value):
+        """
+        mirror put_on_board(board, pos, player, value)
+        """
+        i = pos[1] * 19 + pos[0]
+        lines = self._lines[player]
+        tile = self._tiles[i]
+        if bool(value) == bool(tile & (1 << player)):
+            return
+        hashes = self._hashes
+        for s, key in enumerate(SYMMETRIC_ZOBRIST[player][i]):
+            hashes[s] ^= key
+        if value:
+            for line, bit, _, _ in LINES[i]:
+                lines[line] |= bit
+            self._tiles[i] |= 1 << player
+            if not tile:
+                self._set_empty(i, False)
+        else:
+            for line, bit, _, _ in LINES[i]:
+                lines[line] &= ~bit
+            self._tiles[i] &= ~(1 << player)
+            if tile and not self._tiles[i]:
+                self._set_empty(i, True)
+
+    def _set_empty(self, i, empty):
+        """
+        update empty tiles informations for tile i
+        """
+        self._empty[i] = empty
+        delta = 1 if empty else -1
+        i += 1
+        while i <= 361:
+            self._fenwick[i] += delta
+            i += i & -i
+
+    def get_hashes(self):
+        """
+        return zobrist hashes of the board under the 8 symmetries, hash of the board itself first
+        """
+        return self._hashes
+
+    def get_empty(self):
+        """
+        return flattened boolean array (361), True for empty tiles
+        updated in place by next moves, copy it to keep it
+        """
+        return self._empty
+
+    def get_pos(self, nb_child):
+        """
+        take a number of children (index among empty tiles), and return x and y position on board
+        """
+        fenwick = self._fenwick
+        i, bit = 0, 256
+        while bit:
+            if i + bit <= 361 and fenwick[i + bit] <= nb_child:
+                i += bit
+                nb_child -= fenwick[i]
+            bit >>= 1
+        return i % 19, i // 19
+
+    def get_child_number(self, pos):
+        """
+        take x and y position on board, and return number of empty tiles before it
+        """
+        fenwick = self._fenwick
+        i, n = pos[1] * 19 + pos[0], 0
+        while i:
+            n += fenwick[i]
+            i -= i & -i
+        return n
+
+    def is_win(self, player, pos):
+        """
+        same as mcts.evaluate: 1 if player has five in a row going through pos, else 0
+        """
+        lines = self._lines[player]
+        for line, _, shift, mask in LINES[pos[1] * 19 + pos[0]]:
+            w = (lines[line] >> shift) & mask
+            if w & (w >> 1) & (w >> 2) & (w >> 3) & (w >> 4):
+                return 1
+        return 0
+
+def board_hashes(board):
+    """
+    compute State(board).get_hashes() from scratch, vectorized
+    """
+    hashes = np.zeros(8, np.uint64)
+    for player in (0, 1):
+        tiles = np.flatnonzero(board[:,:,player])
+        hashes ^= np.bitwise_xor.reduce(ZOBRIST[player][INVERSE_SYMMETRIES[:, tiles]], axis=1)
+    return [ int(h) for h in hashes ]
+
+def find_wins(boards, player):
+    """
+    vectorized check of a batch of boards (n, 19, 19, 3)
+    return array of booleans, True where player has five in a row anywhere on the board
+    """
+    m = boards[..., player] != 0
+    found = np.zeros(len(boards), bool)
+    # (dy, dx) of each direction and the corresponding first tiles
+    for dy, dx in ((0, 1), (1, 0), (1, 1), (1, -1)):
+        h, w = 19 - 4 * dy, 19 - 4 * abs(dx)
+        x0 = 4 if dx < 0 else 0
+        run = np.ones((len(boards), h, w), bool)
+        for k in range(5):
+            y, x = k * dy, x0 + k * dx
+            run &= m[:, y:y + h, x:x + w]
+        found |= run.any(axis=(1, 2))
+    return found
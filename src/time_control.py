@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""
+time management of the search
+how long a move may think from the piskvork timeout settings, and when the search must stop
+"""
+
+import threading
+import time
+import numpy as np
+
+class TimeManager(object):
+    """
+    split the remaining match time across the expected remaining moves, within the turn timeout
+    """
+    def __init__(self, infos, expected_moves=50, minimum_moves=10, margin=0.1, overhead=0.05):
+        """
+        infos: Protocol.infos, timeouts in milliseconds (timeout_match 0: no match limit)
+        expected_moves: expected number of moves of a player in a game
+        minimum_moves: the remaining time is split across at least minimum_moves moves
+        margin: fraction of the budget kept for safety, overhead: seconds kept for the rest of the turn
+        """
+        self._infos = infos
+        self._expected_moves = expected_moves
+        self._minimum_moves = minimum_moves
+        self._margin = margin
+        self._overhead = overhead
+
+    def budget(self, board):
+        """
+        return seconds allowed to search the next move on board
+        """
+        budget = int(self._infos["timeout_turn"]) / 1000
+        if int(self._infos["timeout_match"]):
+            stones = int(np.sum(board[:,:,0]) + np.sum(board[:,:,1]))
+            moves = max(self._minimum_moves, self._expected_moves - stones // 2)
+            budget = min(budget, int(self._infos["time_left"]) / 1000 / moves)
+        return max(0, budget * (1 - self._margin) - self._overhead)
+
+    def deadline(self, board):
+        """
+        return time at which the search of the next move on board must stop
+        """
+        return time.time() + self.budget(board)
+
+class SearchBudget(object):
+    """
+    hand out playouts to the search until trials are done or deadline is reached
+    with a deadline, stop early once the most visited move can no longer change
+    may be shared by searching threads
+    """
+    def __init__(self, trials=None, deadline=None, check=16, stop=None):
+        """
+        trials: maximum number of playouts (None: no limit), deadline: time.time() to stop at
+        check: number of playouts between two checks of the most visited move
+        stop: function returning true when the search must stop (pondering), checked before each playout
+        """
+        self._trials = trials
+        self._deadline = deadline
+        self._check = check
+        self._stop = stop
+        self._start = time.time()
+        self._done = 0
+        self._stopped = False
+        self._lock = threading.Lock()
+
+    def _settled(self, root, now):
+        """
+        true if the remaining playouts cannot make another move the most visited
+        """
+        remaining = self._done / max(now - self._start, 1e-6) * (self._deadline - now)
+        if self._trials is not None:
+            remaining = min(remaining, self._trials - self._done)
+        frequencies = root.get_frequencies()
+        if len(frequencies) < 2:
+            return True
+        second, first = np.partition(frequencies, -2)[-2:]
+        return first - second > remaining
+
+    def take(self, root, n=1):
+        """
+        reserve up to n playouts on tree of root, return the number reserved (0: stop searching)
+        the first call reserves at least one playout, even past the deadline
+        """
+        with self._lock:
+            if self._stopped:
+                return 0
+            if self._stop is not None and self._stop():
+                self._stopped = True
+                return 0
+            if self._trials is not None:
+                n = min(n, self._trials - self._done)
+            if n > 0 and self._deadline is not None:
+                now = time.time()
+                if now >= self._deadline:
+                    # at least one playout, the move is chosen from the visits of the root
+                    n = 0 if self._done else 1
+                elif self._done // self._check != (self._done + n) // self._check and self._settled(root, now):
+                    n = 0
+            if n <= 0:
+                self._stopped = True
+                return 0
+            self._done += n
+            return n
+
+    def done(self):
+        """
+        number of playouts handed out
+        """
+        return self._done
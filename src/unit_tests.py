@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
 
+import os
+import shutil
+import tempfile
+import time
 import numpy as np
+from labels import FIELDS, LabelWriter, ReplayBuffer, label_directory, read_shard
 from mcts import evaluate, expand, mcts
-from network import Network
-from node import Node
-from utils_board import conv_map
+from node import Node, Tree
+from numpy_network import NumpyNetwork
+from reinforcement import game, save_final_label
+from cache import EvalCache
+from state import State, board_hashes, find_wins
+from utils_board import SYMMETRIES, random_symmetries, conv_map, put_on_board
+from utils_board import get_pos_on_board, get_child_number, get_empty_tiles
 
 def test_evaluate_graphic():
     """
@@ -66,6 +75,7 @@ def test_winning_move_when_multiple():
         if not has_winning_move:
             continue
 
+        from network import Network
         network = Network(0)
         node = Node(0)
         expand(node, board, has_winning_move - 1, network)
@@ -107,6 +117,7 @@ def test_winning_move_when_one():
         if not has_winning_move:
             continue
 
+        from network import Network
         network = Network(0)
         node = Node(0)
         expand(node, board, has_winning_move - 1, network)
@@ -148,6 +159,7 @@ def test_loosing_move():
         if not has_winning_move:
             continue
 
+        from network import Network
         network = Network(0)
         node = Node(0)
         expand(node, board, has_winning_move - 1, network)
@@ -161,6 +173,353 @@ def test_loosing_move():
 
         return True
 
+def test_state_evaluate():
+    """
+    test incremental and vectorized win detection against evaluate on random boards
+    return true if all agree
+    """
+    for _ in range(20):
+        tmp = np.random.randint(3, size=(19, 19))
+        board = np.zeros((19, 19, 3), dtype=np.int8)
+        board[:,:,0] = tmp == 1
+        board[:,:,1] = tmp == 2
+        state = State(board)
+        for player in range(2):
+            win = False
+            for y in range(19):
+                for x in range(19):
+                    value = evaluate(board, player, (x, y))
+                    if value != state.is_win(player, (x, y)):
+                        return False
+                    win = win or (board[y, x, player] and value)
+            if win != find_wins(board[None, :], player)[0]:
+                return False
+    return True
+
+class EquivariantNetwork(object):
+    """
+    stub network commuting with the board symmetries: symmetric 3x3 sums of stones, value from stone count
+    evaluated: number of boards evaluated
+    """
+    generation = 0
+    evaluated = 0
+
+    def infer(self, board):
+        return self.infer_batch(board[None, :])
+
+    def infer_batch(self, boards):
+        self.evaluated += len(boards)
+        stones = (boards[:,:,:,0] + 2 * boards[:,:,:,1]).astype(np.float32)
+        padded = np.pad(stones, ((0, 0), (1, 1), (1, 1)), "constant")
+        near = sum(padded[:, y:y + 19, x:x + 19] for y in range(3) for x in range(3))
+        return (near + 5 * stones).reshape((len(boards), 361)), stones.sum(axis=(1, 2)) / 100
+
+def random_board(stones=40, seed=None):
+    """
+    return board (19, 19, 3) with stones random stones of each player
+    """
+    rng = np.random.RandomState(seed)
+    board = np.zeros((19, 19, 3), dtype=np.int8)
+    tiles = rng.choice(361, 2 * stones, replace=False)
+    board.reshape((361, 3))[tiles[:stones], 0] = 1
+    board.reshape((361, 3))[tiles[stones:], 1] = 1
+    return board
+
+def test_cache_symmetries():
+    """
+    test cached policies of symmetric boards against the network, with infer, infer_batch and State hashes
+    return true if all agree
+    """
+    network = EquivariantNetwork()
+    board = random_board(seed=1)
+    boards = np.array([ board.reshape((361, 3))[SYMMETRIES[s]].reshape((19, 19, 3)) for s in range(8) ])
+    ps, vs = network.infer_batch(boards)
+    # all symmetric boards hit the entry of the first one
+    cache = EvalCache(network)
+    for s, b in enumerate(boards):
+        hashes = State(b).get_hashes() if s % 2 else None
+        p, v = cache.infer(b, hashes)
+        if not np.allclose(p[0], ps[s]) or not np.isclose(v[0], vs[s]):
+            return False
+    if cache.misses != 1 or cache.hits != 7:
+        return False
+    # symmetric boards of a batch are one position, sent once to the network, then all hits
+    evaluated = network.evaluated
+    for cache in (EvalCache(network), cache):
+        p, v = cache.infer_batch(np.concatenate([ boards, boards ]))
+        if not np.allclose(p, np.concatenate([ ps, ps ])) or not np.allclose(v, np.concatenate([ vs, vs ])):
+            return False
+    return network.evaluated == evaluated + 1
+
+def test_state_index():
+    """
+    test hashes, empty tiles and child numbers of State against the board after random puts and undos
+    return true if all agree
+    """
+    rng = np.random.RandomState(2)
+    board = random_board(20, seed=2)
+    state = State(board)
+    played = []
+    for _ in range(300):
+        if played and rng.rand() < 0.4:
+            pos, player = played.pop(rng.randint(len(played)))
+            put_on_board(board, pos, player, 0, state)
+        else:
+            empty = np.flatnonzero(get_empty_tiles(board))
+            i = empty[rng.randint(len(empty))]
+            pos, player = (i % 19, i // 19), rng.randint(2)
+            put_on_board(board, pos, player, 1, state)
+            played.append((pos, player))
+        if state.get_hashes() != board_hashes(board):
+            return False
+        if not np.array_equal(state.get_empty(), get_empty_tiles(board)):
+            return False
+        empty = int(np.sum(get_empty_tiles(board)))
+        for n in rng.randint(empty, size=5):
+            pos = get_pos_on_board(board, n)
+            if state.get_pos(n) != pos or get_child_number(board, pos, state) != get_child_number(board, pos):
+                return False
+    return True
+
+def test_labels_round_trip():
+    """
+    play a stub network game, save it, and rebuild its labels through the replay buffer
+    check board before each move, player plane, policy over empty tiles and outcome signs
+    return true if all agree
+    """
+    (start, turns), winner = game(EquivariantNetwork(), EquivariantNetwork(), start=np.zeros((19, 19, 3), np.int8))
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp()
+    try:
+        # labels are found relative to the working directory, ../labels/labels_{version}
+        os.makedirs(os.path.join(directory, "src"))
+        os.chdir(os.path.join(directory, "src"))
+        with LabelWriter(label_directory(1), "test") as writer:
+            save_final_label((start, turns), winner, writer)
+        labels = ReplayBuffer(1, 1)
+        if len(labels) != len(turns):
+            return False
+        states, policies, outcomes = labels.get(np.arange(len(turns)))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    board = np.copy(start)
+    for (move, tiles, visits, player), state, policy, outcome in zip(turns, states, policies, outcomes):
+        empty = get_empty_tiles(board)
+        if not np.array_equal(state[:,:,:2], board[:,:,:2]) or np.any(state[:,:,2] != player):
+            return False
+        if not np.isclose(np.sum(policy), 1) or np.any(policy[~empty]) or not empty[move]:
+            return False
+        if policy[move] != np.max(policy) or outcome != (1 if player == winner else -1):
+            return False
+        put_on_board(board, (move % 19, move // 19), player, 1)
+    # players alternate, the winner played the last move and has five in a row
+    players = [ player for _, _, _, player in turns ]
+    return players == [ i % 2 for i in range(len(turns)) ] and players[-1] == winner \
+        and find_wins(board[None, :], winner)[0]
+
+def test_labels_interrupted_append():
+    """
+    test that data of an append interrupted before its index was written is dropped by the next writer
+    return true if the shard only holds complete games
+    """
+    rng = np.random.RandomState(3)
+    def record(length):
+        return (np.zeros((19, 19, 3), np.int8), rng.randint(361, size=length), np.arange(length) % 2,
+                np.where(np.arange(length) % 2, -1, 1), [ np.array([ i, i + 1 ]) for i in range(length) ],
+                [ np.array([ 3, 1 ]) for _ in range(length) ])
+    first, second = record(5), record(7)
+    directory = tempfile.mkdtemp()
+    try:
+        with LabelWriter(directory, "test") as writer:
+            writer.append(*first)
+        # interrupted append: data written, index not updated
+        for name, _, _, _ in FIELDS:
+            with open(os.path.join(directory, "test." + name), "ab") as f:
+                f.write(b"\x7f" * 13)
+        with LabelWriter(directory, "test") as writer:
+            writer.append(*second)
+        shard = read_shard(os.path.join(directory, "test"))
+        sizes = [ os.path.getsize(os.path.join(directory, "test." + name)) for name, _, _, _ in FIELDS ]
+        expected = [ shard[name].nbytes for name, _, _, _ in FIELDS ]
+    finally:
+        shutil.rmtree(directory)
+    return sizes == expected and list(shard["lengths"]) == [ 5, 7 ] \
+        and np.array_equal(shard["moves"], np.concatenate([ first[1], second[1] ])) \
+        and np.array_equal(shard["visits"], np.tile([ 3, 1 ], 12))
+
+def test_past_deadline():
+    """
+    test that a search whose deadline is already past still plays one playout, next to the only stone
+    and that a search without trials nor deadline is rejected
+    return true if both hold
+    """
+    board = np.zeros((19, 19, 3), np.int8)
+    put_on_board(board, (9, 9), 0, 1)
+    board[:,:,2] = 1
+    network = EquivariantNetwork()
+    root = Node(0, Tree())
+    expand(root, board, 1, network)
+    (x, y), _, _, _, _ = mcts(board, 1, root, network, trials=None, deadline=time.time() - 1)
+    if np.sum(root.get_frequencies()) != 1 or max(abs(x - 9), abs(y - 9)) != 1:
+        return False
+    try:
+        mcts(board, 0, Node(0, Tree()), network, trials=None)
+    except ValueError:
+        return True
+    return False
+
+def test_compact_tree():
+    """
+    search a tree with transpositions, compact it and the subtree of the most visited move
+    return true if the new trees hold the same nodes, with their shared children, and can be searched further
+    """
+    def same(old, new):
+        # walk both trees together, blocks shared in the old tree must be shared in the new one
+        old_tree, new_tree = old.get_tree(), new.get_tree()
+        blocks = dict()
+        stack = [ (old, new) ]
+        while stack:
+            a, b = stack.pop()
+            if a.get_value() != b.get_value() or a.get_frequency() != b.get_frequency() or a.leaf() != b.leaf() \
+               or old_tree.probability[a.get_index()] != new_tree.probability[b.get_index()]:
+                return False
+            if a.leaf():
+                continue
+            offset = old_tree.offset[a.get_index()]
+            if blocks.setdefault(offset, new_tree.offset[b.get_index()]) != new_tree.offset[b.get_index()]:
+                return False
+            stack.extend((a.get_child(n), b.get_child(n)) for n in range(old_tree.count[a.get_index()]))
+        return len(set(blocks.values())) == len(blocks) and len(new_tree.table) <= len(old_tree.table)
+
+    board = np.zeros((19, 19, 3), np.int8)
+    put_on_board(board, (9, 9), 0, 1)
+    network = EquivariantNetwork()
+    state = State(board)
+    root = Node(0, Tree(transposition=True))
+    expand(root, board, 1, network, state)
+    mcts(board, 1, root, network, trials=300, state=state)
+    copy = root.compact()
+    if copy.get_tree().size != root.get_tree().size or not same(root, copy):
+        return False
+    old = root.get_child(root.get_max_frequency_move())
+    new = old.compact()
+    if new.get_tree().size >= root.get_tree().size or new.get_index() != 0 or not same(old, new):
+        return False
+    frequency = np.sum(new.get_frequencies())
+    mcts(board, 0, new, network, trials=50, state=state)
+    return np.sum(new.get_frequencies()) == frequency + 50
+
+class UniformNetwork(object):
+    """
+    stub network with uniform policy and null value, sleeping like a network releasing the gil
+    """
+    generation = 0
+
+    def infer(self, board):
+        return self.infer_batch(board[None, :])
+
+    def infer_batch(self, boards):
+        time.sleep(0.001)
+        return np.full((len(boards), 361), 1 / 361, np.float32), np.zeros(len(boards), np.float32)
+
+def test_search_parallel():
+    """
+    search a shared tree with threads, values are null and no game can be won in so few moves
+    return true if the root has one visit per trial, board and state only hold the chosen move,
+    and no virtual loss is left in the tree
+    """
+    board = random_board(stones=6, seed=2)
+    board[:,:,2] = 0
+    start = np.copy(board)
+    state = State(board)
+    network = UniformNetwork()
+    root = Node(0, Tree())
+    expand(root, board, 0, network, state)
+    (x, y), _, _, _, _ = mcts(board, 0, root, network, trials=200, threads=4, state=state)
+    if np.sum(root.get_frequencies()) != 200:
+        return False
+    put_on_board(start, (x, y), 0, 1)
+    if not np.array_equal(board[:,:,:2], start[:,:,:2]) or state.get_hashes() != board_hashes(board) \
+       or not np.array_equal(state.get_empty(), get_empty_tiles(board)):
+        return False
+    tree = root.get_tree()
+    return not np.any(tree.value[:tree.size])
+
+def test_random_symmetries():
+    """
+    augment a batch of copies of a board and of a policy with a distinct value on each tile
+    return true if each label is one of the 8 symmetries, the same for its state and policy,
+    all 8 symmetries are drawn and the input arrays are left untouched
+    """
+    np.random.seed(5)
+    board = random_board(seed=3)
+    states = np.array([ board ] * 200)
+    policies = np.array([ np.random.permutation(361).astype(np.float32) ] * 200)
+    states_copy, policies_copy = np.copy(states), np.copy(policies)
+    new_states, new_policies = random_symmetries(states, policies)
+    if not np.array_equal(states, states_copy) or not np.array_equal(policies, policies_copy):
+        return False
+    drawn = set()
+    for state, policy in zip(new_states, new_policies):
+        # the distinct policy values tell the symmetry, stones must have moved the same way
+        s = [ s for s in range(8) if np.array_equal(policy, policies[0][SYMMETRIES[s]]) ]
+        if len(s) != 1 or not np.array_equal(state.reshape((361, 3)), board.reshape((361, 3))[SYMMETRIES[s[0]]]):
+            return False
+        drawn.add(s[0])
+    return len(drawn) == 8
+
+def test_numpy_convolution():
+    """
+    test convolution layers of the numpy network (im2col and GEMM) against a direct convolution
+    return true if all agree
+    """
+    rng = np.random.RandomState(4)
+    x = rng.randn(2, 19, 19, 5).astype(np.float32)
+    for ksize in (1, 3):
+        weights = { "conv/kernel": rng.randn(ksize, ksize, 5, 4).astype(np.float32),
+                    "conv/bias": rng.randn(4).astype(np.float32),
+                    "bn/scale": rng.rand(4).astype(np.float32), "bn/shift": rng.randn(4).astype(np.float32) }
+        # sum over the kernel of the shifted input times the weights of the shift, 'SAME' padding
+        pad = ksize // 2
+        padded = np.pad(x, ((0, 0), (pad, pad), (pad, pad), (0, 0)), "constant")
+        expected = np.zeros((2, 19, 19, 4), np.float32)
+        kernel = weights["conv/kernel"]
+        for dy in range(ksize):
+            for dx in range(ksize):
+                for i in range(5):
+                    for o in range(4):
+                        expected[..., o] += padded[:, dy:dy + 19, dx:dx + 19, i] * kernel[dy, dx, i, o]
+        expected = np.maximum(expected + weights["conv/bias"], 0) * weights["bn/scale"] + weights["bn/shift"]
+        out = NumpyNetwork(0, weights=weights)._convolution(x, "conv", "bn")
+        if not np.allclose(out, expected, atol=1e-4):
+            return False
+    return True
+
+def test_numpy_network():
+    """
+    test the numpy network against the tensorflow network, full and inference only, on the same export
+    return true if all agree
+    """
+    from network import Network
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp()
+    try:
+        # models are found relative to the working directory, ../models
+        os.makedirs(os.path.join(directory, "src"))
+        os.makedirs(os.path.join(directory, "models"))
+        os.chdir(os.path.join(directory, "src"))
+        network = Network(1, logs=False, blocks=2, filters=8)
+        network.export(wait=True)
+        networks = (network, Network(1, inference=True, logs=False), NumpyNetwork(1))
+        boards = np.array([ random_board(seed=seed) for seed in range(8) ])
+        results = [ net.infer_batch(boards) for net in networks ]
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    return all(np.allclose(p, results[0][0], atol=1e-4) and np.allclose(v, results[0][1], atol=1e-4)
+               for p, v in results[1:])
+
 def basic_win():
     """
     test with simple env
@@ -188,16 +547,33 @@ def basic_win():
     player = 0
     pos = (0, 0)
     root = Node(0)
-    net = Network(-1)
+    # evaluate checks the line of a stone already played
+    put_on_board(board, pos, player, 1)
 
     return evaluate(board, player, pos)
 
 def main():
+    # tests without network
     assert(basic_win())
+    assert(test_state_evaluate())
+    assert(test_state_index())
+    assert(test_cache_symmetries())
+    assert(test_labels_round_trip())
+    assert(test_labels_interrupted_append())
+    assert(test_past_deadline())
+    assert(test_compact_tree())
+    assert(test_search_parallel())
+    assert(test_random_symmetries())
+    assert(test_numpy_convolution())
+    try:
+        import tensorflow
+    except ImportError:
+        print ("tensorflow not installed, network tests skipped")
+        return
     assert(test_winning_move_when_multiple())
     assert(test_winning_move_when_one())
     assert(test_loosing_move())
-    pass
+    assert(test_numpy_network())
 
 if __name__ ==  '__main__':
     main()
@@ -59,25 +59,79 @@ def init_map():
                               [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
                               [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]]))
 
+def _symmetries():
+    """
+    return index arrays (8, 361) of the 8 board symmetries (4 rotations, with and without reflection)
+    symmetry s of a flattened board b is b[SYMMETRIES[s]], undone with INVERSE_SYMMETRIES[s]
+    """
+    tiles = np.arange(19 * 19).reshape((19, 19))
+    symmetries = np.array([ np.rot90(t, r).flatten() for t in (tiles, np.fliplr(tiles)) for r in range(4) ])
+    return symmetries, np.argsort(symmetries, axis=1)
+
+SYMMETRIES, INVERSE_SYMMETRIES = _symmetries()
+
+def random_symmetries(states, policies):
+    """
+    apply a random one of the 8 board symmetries to each label of a batch
+    states (n, 19, 19, 3), policies (n, 361), return new arrays, inputs are left untouched
+    """
+    n = len(states)
+    symmetries = SYMMETRIES[np.random.randint(8, size=n)]
+    rows = np.arange(n)[:, None]
+    states = states.reshape((n, 19 * 19, -1))[rows, symmetries].reshape((n, 19, 19, -1))
+    return states, policies[rows, symmetries]
+
 def update_board_player(board, player):
     """                                                                                                  
     update third layer of board (white(0) => all zeros, black(1) => all ones)                            
     """
     board[:,:,2] = player
 
-def put_on_board(board, pos, player, value):
+def put_on_board(board, pos, player, value, state=None):
     """                                                                                                  
     act on board, with player (0, 1), at x, y with value (0, 1)                                          
+    keep state (incremental informations about board) up to date if given
     """
     board[pos[1], pos[0], player] = value
+    if state is not None:
+        state.update(pos, player, value)
 
-def get_pos_on_board(board, nb_child):
+def get_pos_on_board(board, nb_child, state=None):
     """                                                                                                  
     take a number of children, and return x and y position on board                                      
+    O(log n) with the empty tiles index of state if given
     """
+    if state is not None:
+        return state.get_pos(nb_child)
     # get unidimensional board of zero and one                                                           
     complete_board = (board[:,:,0] + board[:,:,1]).flatten()
     # get index of nb_child zero                                                                         
     pos = (complete_board == 0).nonzero()[0][nb_child]
     return pos % 19, pos // 19
 
+
+def get_child_number(board, pos, state=None):
+    """
+    take x and y position on board, and return number of children (number of empty tiles before it)
+    O(log n) with the empty tiles index of state if given
+    """
+    if state is not None:
+        return state.get_child_number(pos)
+    complete_board = (board[:,:,0] + board[:,:,1]).flatten()
+    return np.sum((complete_board[:(pos[1] * 19 + pos[0])] == 0))
+
+def get_empty_tiles(board, state=None):
+    """
+    return flattened boolean array (361), True for empty tiles
+    """
+    if state is not None:
+        return state.get_empty()
+    return (board[:,:,0] + board[:,:,1]).flatten() == 0
+
+def policy_distribution(boards, policies):
+    """
+    return network policies (n, 361) of boards (n, 19, 19, 3) as distributions over empty tiles
+    """
+    empty = (boards[:,:,:,0] + boards[:,:,:,1]).reshape((len(boards), -1)) == 0
+    p = np.where(empty, np.maximum(policies, 1e-6), 0)
+    return p / np.maximum(np.sum(p, axis=1, keepdims=True), 1e-12)